@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+import tracemalloc
+
+'''
+  Shared helpers for the benchmark scripts in this directory.
+  Importing this module makes the data processing modules importable, as they import each other
+  as top-level modules (e.g. `from db_manager import ...`), along with the visualization package.
+'''
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DATA_PROCESSING_DIRECTORY = os.path.join(SRC_DIRECTORY, 'data_processing')
+for directory in [SRC_DIRECTORY, DATA_PROCESSING_DIRECTORY]:
+  if directory not in sys.path:
+    sys.path.insert(0, directory)
+
+def best_time(func, repeat: int = 3) -> float:
+  '''
+    Runs `func` `repeat` times and returns the fastest run time in seconds
+  '''
+  timings = []
+  for _ in range(repeat):
+    start_time = time.perf_counter()
+    func()
+    timings.append(time.perf_counter() - start_time)
+  return min(timings)
+
+def peak_memory(func) -> int:
+  '''
+    Returns the peak memory in bytes allocated while running `func`
+  '''
+  tracemalloc.start()
+  try:
+    func()
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
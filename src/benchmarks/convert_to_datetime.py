@@ -0,0 +1,50 @@
+import argparse
+from datetime import datetime
+
+import pandas as pd
+
+import common
+from load_data import convert_to_datetime
+from synthetic import generate_timestamps
+
+'''
+  Compares the vectorized `convert_to_datetime` against the previous per-row `strptime` implementation.
+  Usage: `python src/benchmarks/convert_to_datetime.py --rows 1000000`
+'''
+
+def legacy_convert_to_datetime(df: pd.DataFrame, column: str) -> pd.DataFrame:
+  '''
+    The previous implementation, which picks a single format from the first row and parses every row in Python
+  '''
+  if df.iloc[0][column][0].isalpha():
+    df[column] = df[column].map(lambda datestr: datetime.strptime(datestr.split(' GMT+0000 ', 1)[0], '%a %b %d %Y %H:%M:%S'))
+  else:
+    df[column] = df[column].map(lambda datestr: datetime.strptime(datestr.split('.', 1)[0].split('+', 1)[0], '%Y-%m-%d %H:%M:%S'))
+
+def run(row_count: int, repeat: int):
+  # The previous implementation can only parse one format per column
+  for text_format_fraction in [0, 1]:
+    timestamps = generate_timestamps(row_count, text_format_fraction)
+    legacy_time = common.best_time(lambda: legacy_convert_to_datetime(pd.DataFrame({'time': timestamps}), 'time'), repeat)
+    vectorized_time = common.best_time(lambda: convert_to_datetime(pd.DataFrame({'time': timestamps}), 'time'), repeat)
+
+    legacy = pd.DataFrame({'time': timestamps})
+    legacy_convert_to_datetime(legacy, 'time')
+    vectorized = pd.DataFrame({'time': timestamps})
+    convert_to_datetime(vectorized, 'time')
+    matches = (vectorized['time'].dt.tz_convert(None).dt.floor('s') == legacy['time']).all()
+
+    format_name = 'text' if text_format_fraction else 'ISO'
+    print('{:,} {} timestamps: legacy {:.3f}s, vectorized {:.3f}s ({:.1f}x faster), results match: {}'.format(
+      row_count, format_name, legacy_time, vectorized_time, legacy_time / vectorized_time, matches))
+
+  timestamps = generate_timestamps(row_count, 0.5)
+  vectorized_time = common.best_time(lambda: convert_to_datetime(pd.DataFrame({'time': timestamps}), 'time'), repeat)
+  print('{:,} mixed timestamps: vectorized {:.3f}s (not supported by legacy)'.format(row_count, vectorized_time))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark timestamp parsing.')
+  parser.add_argument('--rows', type=int, default=1000000, help='Number of timestamps to parse')
+  parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the fastest of which is reported')
+  args = parser.parse_args()
+  run(args.rows, args.repeat)
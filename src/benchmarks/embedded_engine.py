@@ -0,0 +1,50 @@
+import argparse
+import tempfile
+
+import common
+from db_manager import EmbeddedEngine, get_dashboard_aggregates, get_sql_engine, update_user_month_activity
+from export_tables import export_tables
+
+'''
+  Compares computing the dashboard aggregates with the embedded DuckDB engine over exported Parquet files against Postgres.
+  Building the user_month_activity rollup from every event is timed separately, as the embedded engine does it whenever
+  the files change while Postgres keeps its rollup up to date at load time.
+  Usage: `python src/benchmarks/embedded_engine.py` (with `DB_CONNECTION_STRING` pointing at a loaded Postgres database)
+'''
+
+def rebuild_postgres_rollup(engine):
+  '''
+    Rebuilds the Postgres rollup from every event, then rolls back so the database is left unchanged
+  '''
+  connection = engine.raw_connection()
+  try:
+    update_user_month_activity(connection, rebuild=True)
+  finally:
+    connection.rollback()
+    connection.close()
+
+def run(repeat: int):
+  postgres_engine = get_sql_engine()
+  with tempfile.TemporaryDirectory() as directory:
+    export_tables(directory, postgres_engine)
+    embedded_engine = EmbeddedEngine(directory)
+
+    postgres_rollup_time = common.best_time(lambda: rebuild_postgres_rollup(postgres_engine), repeat)
+    embedded_rollup_time = common.best_time(lambda: EmbeddedEngine(directory).connect().close(), repeat)
+    postgres_time = common.best_time(lambda: get_dashboard_aggregates(postgres_engine), repeat)
+    embedded_time = common.best_time(lambda: get_dashboard_aggregates(embedded_engine), repeat)
+
+    postgres_results = get_dashboard_aggregates(postgres_engine)
+    embedded_results = get_dashboard_aggregates(embedded_engine)
+    matches = all(postgres.equals(embedded) for postgres, embedded in zip(postgres_results, embedded_results))
+
+  print('Rollup: Postgres {:.3f}s, embedded {:.3f}s ({:.1f}x faster)'.format(
+    postgres_rollup_time, embedded_rollup_time, postgres_rollup_time / embedded_rollup_time))
+  print('Dashboard aggregates: Postgres {:.3f}s, embedded {:.3f}s ({:.1f}x faster), results match: {}'.format(
+    postgres_time, embedded_time, postgres_time / embedded_time, matches))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the embedded engine against Postgres.')
+  parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the fastest of which is reported')
+  args = parser.parse_args()
+  run(args.repeat)
@@ -0,0 +1,60 @@
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import pandas as pd
+
+import common
+from load_data import convert_to_datetime, load_events
+from synthetic import generate_analytics
+
+'''
+  Compares the batched JSON decoding in `load_events` against the previous per-row `json_normalize` implementation.
+  Usage: `python src/benchmarks/load_events.py --rows 100000 --json-workers 4`
+'''
+
+def legacy_load_events(analytics: pd.DataFrame) -> [pd.DataFrame, pd.DataFrame]:
+  '''
+    The previous implementation, which normalizes every row into its own DataFrame and concatenates them
+  '''
+  analytics.rename(columns={'version':'app_version'}, inplace=True)
+  analytics.drop(columns=['arch', 'avail_ram', 'country', 'duration', 'first_time', 'locale', 'module_version', 'os_version', 'platform', 'error_hash'], inplace=True)
+  analytics.dropna(subset=['user_id'], inplace=True)
+  convert_to_datetime(analytics, 'time')
+  analytics = (pd.concat({i: pd.json_normalize(json.loads(datum)) for i, datum in analytics.pop('data').items()})
+          .reset_index(level=1, drop=True)
+          .join(analytics)
+          .reset_index(drop=True))
+
+  is_screen_view_row = analytics.type.str.startswith('SCREEN_VIEW')
+  page_events = analytics.loc[is_screen_view_row]
+  page_events = page_events.drop(columns=['version', 'action', 'type', 'app_version'])
+  action_events = analytics.loc[~is_screen_view_row]
+  action_events = action_events.drop(columns=['version', 'screen'])
+
+  return [action_events, page_events]
+
+def run(row_count: int, json_workers: int, repeat: int):
+  analytics = generate_analytics(row_count)
+
+  legacy_time = common.best_time(lambda: legacy_load_events(analytics.copy()), repeat)
+  legacy_memory = common.peak_memory(lambda: legacy_load_events(analytics.copy()))
+  legacy_results = legacy_load_events(analytics.copy())
+  # Started once, like the loader does, so that the runs time decoding rather than starting processes
+  with ProcessPoolExecutor(max_workers=json_workers) if json_workers > 1 else nullcontext() as json_executor:
+    batched_time = common.best_time(lambda: load_events(analytics.copy(), json_executor, json_workers), repeat)
+    batched_memory = common.peak_memory(lambda: load_events(analytics.copy(), json_executor, json_workers))
+    batched_results = load_events(analytics.copy(), json_executor, json_workers)
+  matches = all(legacy.equals(batched) for legacy, batched in zip(legacy_results, batched_results))
+
+  print('{:,} events: legacy {:.3f}s / {:,.0f} MB peak, batched ({} JSON workers) {:.3f}s / {:,.0f} MB peak ({:.1f}x faster), results match: {}'.format(
+    row_count, legacy_time, legacy_memory / 2**20, json_workers, batched_time, batched_memory / 2**20, legacy_time / batched_time, matches))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark decoding of the analytics JSON data column.')
+  parser.add_argument('--rows', type=int, default=100000, help='Number of events to decode')
+  parser.add_argument('--json-workers', type=int, default=1, help='Number of processes used by the batched decoder')
+  parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the fastest of which is reported')
+  args = parser.parse_args()
+  run(args.rows, args.json_workers, args.repeat)
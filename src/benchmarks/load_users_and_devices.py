@@ -0,0 +1,70 @@
+import argparse
+
+import pandas as pd
+from inflection import underscore
+
+import common
+from load_data import convert_to_datetime, load_users_and_devices
+from synthetic import generate_users
+
+'''
+  Compares the single-pass device reshape in `load_users_and_devices` against the previous implementation,
+  which appends one DataFrame per device number.
+  Usage: `python src/benchmarks/load_users_and_devices.py --users 100000 --max-devices 10`
+'''
+
+def legacy_load_users_and_devices(users: pd.DataFrame) -> [pd.DataFrame, pd.DataFrame]:
+  '''
+    The previous implementation, which slices 4 columns at a time for each device number.
+    `DataFrame.append` was removed in pandas 2, so the appends are written as the equivalent `pd.concat`.
+  '''
+  users.drop(columns=['_id', 'appId', '__v', 'updatedAt', 'props.version'], inplace=True)
+  user_info = users.filter(items=['userId', 'createdAt', 'props.country', 'props.locale'])
+  user_info.columns = user_info.columns.str.replace('props.', '', regex=False)
+  user_info.rename(columns=lambda c: underscore(c), inplace=True)
+  convert_to_datetime(user_info, 'created_at')
+
+  device_info = users.filter(regex='userId|devices.*(?<!osVersion)$')
+  device_info.columns = device_info.columns.str.replace(r'devices\.\d+\.', '', regex=True)
+  DEVICE_DATA_COLUMN_COUNT = 4  # Each device record has 4 data columns
+  data_column_count = (len(device_info.columns) - 1)
+  max_devices = data_column_count // DEVICE_DATA_COLUMN_COUNT
+  all_device_info = None
+  for i in range(max_devices):
+    curr_data_columns = list(range(1 + (i * DEVICE_DATA_COLUMN_COUNT), ((i + 1) * DEVICE_DATA_COLUMN_COUNT) + 1))
+    curr_device_info = device_info.iloc[:, [0] + curr_data_columns]
+    curr_device_info = curr_device_info.dropna()
+    if all_device_info is not None:
+      all_device_info = pd.concat([all_device_info, curr_device_info])
+    else:
+      all_device_info = curr_device_info
+  all_device_info.columns = all_device_info.columns.str.replace('^_id', 'device_id', regex=True)
+  all_device_info.rename(columns=lambda c: underscore(c), inplace=True)
+  convert_to_datetime(all_device_info, 'last_seen')
+
+  return [user_info, all_device_info]
+
+def run(user_count: int, max_devices: int, repeat: int):
+  users = generate_users(user_count, max_devices)
+
+  legacy_time = common.best_time(lambda: legacy_load_users_and_devices(users.copy()), repeat)
+  reshaped_time = common.best_time(lambda: load_users_and_devices(users.copy()), repeat)
+  legacy_memory = common.peak_memory(lambda: legacy_load_users_and_devices(users.copy()))
+  reshaped_memory = common.peak_memory(lambda: load_users_and_devices(users.copy()))
+
+  [legacy_users, legacy_devices] = legacy_load_users_and_devices(users.copy())
+  [reshaped_users, devices] = load_users_and_devices(users.copy())
+  matches = (legacy_users.equals(reshaped_users)
+             and legacy_devices.reset_index(drop=True).equals(devices.astype({'platform': object, 'version': object})))
+
+  print('{:,} users with up to {} devices ({:,} devices): legacy {:.3f}s / {:,.0f} MB peak, reshaped {:.3f}s / {:,.0f} MB peak ({:.1f}x faster), results match: {}'.format(
+    user_count, max_devices, len(devices), legacy_time, legacy_memory / 2**20, reshaped_time, reshaped_memory / 2**20,
+    legacy_time / reshaped_time, matches))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark normalizing the devices of a users export.')
+  parser.add_argument('--users', type=int, default=100000, help='Number of users in the export')
+  parser.add_argument('--max-devices', type=int, default=10, help='Number of devices.<n>.* column sets in the export')
+  parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the fastest of which is reported')
+  args = parser.parse_args()
+  run(args.users, args.max_devices, args.repeat)
@@ -0,0 +1,259 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+from bokeh.embed import file_html
+from bokeh.models import Column
+from bokeh.resources import CDN
+
+import common
+import db_manager
+from ingestion_log import clear_ingestion_log, ensure_ingestion_log, fingerprint_file, record_ingested_file
+from load_data import EVENT_TABLES, convert_to_datetime, load_events, load_file, load_users_and_devices
+from synthetic import write_exports
+from visualization import monthly_user_map, monthly_user_plot
+
+'''
+  Times every stage of building the dashboard from raw exports, from parsing the CSV files to the size of the HTML page,
+  and writes the time, peak memory and rows per second of each stage to a JSON report.
+  Reports of earlier runs can be compared against to spot regressions and improvements.
+  Usage: `python src/benchmarks/pipeline.py --events 1000000 --users 50000 --report pipeline.json --compare previous.json`
+  The database stages replace the tables in the database `DB_CONNECTION_STRING` points at. If it is `duckdb:///...`
+  or `--skip-database` is given, the tables are written to temporary Parquet files and queried with the embedded
+  DuckDB engine instead, so every other stage can still be timed without a database server.
+'''
+
+# The db_manager queries that are timed, with the arguments they are called with
+QUERIES = [
+  ['get_total_monthly_users', {}],
+  ['get_total_new_monthly_users', {}],
+  ['get_total_returning_monthly_users', {}],
+  ['get_total_monthly_users_by_country', {}],
+  ['get_total_new_monthly_users_by_country', {}],
+  ['get_dashboard_aggregates', {}],
+  ['get_dashboard_aggregates', {'granularity': 'week'}],
+  ['get_dashboard_aggregates', {'granularity': 'day'}],
+]
+
+def measure(stages: list, name: str, func, row_count = len, repeat: int = 1):
+  '''
+    Runs `func` `repeat` times and records the fastest time in `stages`, along with the peak memory allocated by
+    one more run, which is traced separately so that tracing does not slow down the timed runs.
+    - row_count is the number of rows the stage processes, which its rows per second are computed from,
+      or a function computing it from the result of the stage
+    Returns the result of the last run.
+  '''
+  result = None
+  timings = []
+  for _ in range(repeat):
+    start_time = time.perf_counter()
+    result = func()
+    timings.append(time.perf_counter() - start_time)
+  seconds = min(timings)
+  if callable(row_count):
+    row_count = row_count(result)
+  stage = {
+    'name': name,
+    'seconds': seconds,
+    'rows': row_count,
+    'rows_per_second': row_count / max(seconds, 1e-9),
+    'peak_memory_bytes': common.peak_memory(func),
+  }
+  stages.append(stage)
+  print('{:<48} {:>9.3f}s {:>14,.0f} rows/sec {:>9,.1f} MB peak'.format(
+    name, seconds, stage['rows_per_second'], stage['peak_memory_bytes'] / 2**20))
+  return result
+
+def write_to_database(engine, export_rows: dict, normalized_exports: list, max_event_time):
+  '''
+    Replaces the tables with the normalized exports and logs the exports as loaded, like load_data.py does,
+    so that cached dashboard queries are not reused for the replaced data
+    - export_rows is the number of rows in each export, by path
+    - normalized_exports holds the tables each export is normalized into and its number of rows, see load_data.normalize_chunks
+  '''
+  connection = engine.raw_connection()
+  try:
+    ensure_ingestion_log(connection)
+    clear_ingestion_log(connection)
+    table_columns = {}
+    for [table_names, row_count, tables] in normalized_exports:
+      load_file([[row_count, tables]], table_names, connection, table_columns)
+    for path, row_count in export_rows.items():
+      [file_size, content_hash] = fingerprint_file(path)
+      record_ingested_file(connection, os.path.basename(path), file_size, content_hash, row_count, max_event_time)
+    connection.commit()
+  finally:
+    connection.close()
+
+def rebuild_rollup(engine):
+  connection = engine.raw_connection()
+  try:
+    db_manager.update_user_month_activity(connection, rebuild=True)
+    connection.commit()
+  finally:
+    connection.close()
+
+def write_to_parquet(directory: str, normalized_exports: list):
+  '''
+    Writes the normalized exports to a Parquet dataset per table in `directory`, like `load_data.py --parquet-directory` does
+  '''
+  for [table_names, _, tables] in normalized_exports:
+    for table_name, df in zip(table_names, tables):
+      db_manager.write_parquet_table(df, table_name, directory, 'benchmark',
+                                     partition_column='time' if table_name in EVENT_TABLES else None)
+
+def build_embedded_rollup(directory: str) -> db_manager.EmbeddedEngine:
+  '''
+    Returns an embedded engine over the Parquet datasets in `directory`, which builds its rollup when it first connects
+  '''
+  engine = db_manager.EmbeddedEngine(directory)
+  engine.connect().close()
+  return engine
+
+def build_dashboard(aggregates: list) -> str:
+  '''
+    Builds the dashboard from the monthly aggregates like main.py does, returning its HTML page
+  '''
+  [total_monthly_users, _, total_returning_users, total_monthly_users_by_country, total_new_monthly_users_by_country] = aggregates
+  [map_row, widget_row] = monthly_user_map.plot_totals(total_monthly_users_by_country, total_new_monthly_users_by_country)
+  monthly_bar_plot_figure = monthly_user_plot.plot_totals(total_monthly_users, total_returning_users)
+  return file_html(Column(widget_row, map_row, monthly_bar_plot_figure), CDN)
+
+def print_comparison(report: dict, previous_report: dict):
+  '''
+    Prints how much faster each stage processed rows than in a previous report, and how its peak memory changed.
+    Speeds are compared in rows per second, so runs over different amounts of data can still be compared.
+  '''
+  previous_stages = {stage['name']: stage for stage in previous_report['stages']}
+  print('\nCompared to {}:'.format(previous_report['created_at']))
+  if previous_report['parameters'] != report['parameters']:
+    print('(with different parameters: {})'.format(previous_report['parameters']))
+  for stage in report['stages']:
+    previous = previous_stages.get(stage['name'])
+    if previous is None:
+      continue
+    print('{:<48} {:>8.2f}x faster {:>+10.1f} MB peak'.format(
+      stage['name'], stage['rows_per_second'] / max(previous['rows_per_second'], 1e-9),
+      (stage['peak_memory_bytes'] - previous['peak_memory_bytes']) / 2**20))
+  if 'html_bytes' in previous_report and 'html_bytes' in report:
+    print('{:<48} {:>+9,.0f} KB'.format('HTML size', (report['html_bytes'] - previous_report['html_bytes']) / 2**10))
+
+def get_exports(directory: str) -> [list, str]:
+  '''
+    Returns the paths of the analytics exports in a directory and of its users export
+  '''
+  file_names = sorted(os.listdir(directory))
+  analytics_paths = [os.path.join(directory, f) for f in file_names if f.startswith('analytics') and f.endswith('.csv')]
+  users_paths = [os.path.join(directory, f) for f in file_names if f.startswith('users') and f.endswith('.csv')]
+  if not analytics_paths or not users_paths:
+    raise FileNotFoundError('No analytics and users exports found in {}'.format(directory))
+  return [analytics_paths, users_paths[0]]
+
+def run(args, directory: str, parquet_directory: str) -> dict:
+  '''
+    Benchmarks the exports in `directory`, returning the report.
+    The embedded engine reads the normalized tables from `parquet_directory`, which should be empty.
+  '''
+  [analytics_paths, users_path] = get_exports(directory)
+  report = {
+    'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    'parameters': {k: v for k, v in vars(args).items() if k not in ('report', 'compare')},
+    'environment': {
+      'python': platform.python_version(),
+      'pandas': pd.__version__,
+      'numpy': np.__version__,
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+    },
+    'input_bytes': sum(os.path.getsize(path) for path in analytics_paths + [users_path]),
+    'stages': [],
+  }
+  stages = report['stages']
+
+  analytics_exports = measure(stages, 'csv_parse.analytics', lambda: [pd.read_csv(path) for path in analytics_paths],
+                              lambda exports: sum(len(df) for df in exports), args.repeat)
+  users = measure(stages, 'csv_parse.users', lambda: pd.read_csv(users_path), repeat=args.repeat)
+  export_rows = dict(zip(analytics_paths + [users_path], [len(df) for df in analytics_exports] + [len(users)]))
+  analytics = pd.concat(analytics_exports, ignore_index=True)
+  del analytics_exports
+  measure(stages, 'convert_to_datetime', lambda: convert_to_datetime(analytics[['time']].copy(), 'time'), len(analytics), args.repeat)
+  with ProcessPoolExecutor(max_workers=args.json_workers) if args.json_workers > 1 else nullcontext() as json_executor:
+    [action_events, page_events] = measure(stages, 'load_events',
+                                           lambda: load_events(analytics.copy(), json_executor, args.json_workers),
+                                           len(analytics), args.repeat)
+  [user_info, device_info] = measure(stages, 'load_users_and_devices', lambda: load_users_and_devices(users.copy()),
+                                     len(users), args.repeat)
+
+  normalized_exports = [[['action_events', 'page_events'], len(analytics), [action_events, page_events]],
+                        [['users', 'devices'], len(users), [user_info, device_info]]]
+  normalized_rows = len(action_events) + len(page_events) + len(user_info) + len(device_info)
+  if args.skip_database or os.getenv('DB_CONNECTION_STRING', '').startswith(db_manager.EMBEDDED_ENGINE_PREFIX):
+    # Only the Postgres stages are skipped, the embedded engine runs the same queries over Parquet files
+    measure(stages, 'parquet_write', lambda: write_to_parquet(parquet_directory, normalized_exports), normalized_rows, args.repeat)
+    engine = measure(stages, 'embedded_rollup', lambda: build_embedded_rollup(parquet_directory), len(action_events), args.repeat)
+  else:
+    engine = db_manager.get_sql_engine()
+    max_event_time = action_events['time'].max().to_pydatetime() if len(action_events) else None
+    measure(stages, 'db_write', lambda: write_to_database(engine, export_rows, normalized_exports, max_event_time),
+            normalized_rows, args.repeat)
+    measure(stages, 'db_rollup', lambda: rebuild_rollup(engine), len(action_events), args.repeat)
+  for [query_name, kwargs] in QUERIES:
+    query = getattr(db_manager, query_name)
+    name = '.'.join(['query', query_name] + list(kwargs.values()))
+    measure(stages, name, lambda: query(engine, **kwargs), len(action_events), args.repeat)
+
+  aggregates = db_manager.get_dashboard_aggregates(engine)
+  [total_monthly_users, _, total_returning_users, total_monthly_users_by_country, total_new_monthly_users_by_country] = aggregates
+  map_rows = len(total_monthly_users_by_country) + len(total_new_monthly_users_by_country)
+  measure(stages, 'build.map', lambda: monthly_user_map.plot_totals(total_monthly_users_by_country, total_new_monthly_users_by_country),
+          map_rows, args.repeat)
+  measure(stages, 'build.plot', lambda: monthly_user_plot.plot_totals(total_monthly_users, total_returning_users),
+          len(total_monthly_users) + len(total_returning_users), args.repeat)
+  html = measure(stages, 'build.html', lambda: build_dashboard(aggregates), map_rows, args.repeat)
+  report['html_bytes'] = len(html.encode('utf-8'))
+  print('{:<48} {:>9,.0f} KB'.format('HTML size', report['html_bytes'] / 2**10))
+  return report
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark every stage of building the dashboard from raw exports.')
+  parser.add_argument('--events', type=int, default=100000, help='Number of synthetic events')
+  parser.add_argument('--users', type=int, default=10000, help='Number of synthetic users')
+  parser.add_argument('--max-devices', type=int, default=3, help='Largest number of devices per synthetic user')
+  parser.add_argument('--countries', type=int, default=10, help='Number of countries synthetic users come from')
+  parser.add_argument('--text-format-fraction', type=float, default=0.5,
+                      help="Share of synthetic timestamps written in the 'Sun Sep 27 2020 ...' format")
+  parser.add_argument('--days', type=int, default=365, help='Number of days the synthetic events are spread over')
+  parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+  parser.add_argument('--data-directory', default=None,
+                      help='Benchmark the analytics.*.csv and users.*.csv exports in this directory instead of synthetic ones')
+  parser.add_argument('--json-workers', type=int, default=1, help='Number of processes used to decode the JSON data column')
+  parser.add_argument('--repeat', type=int, default=1, help='Number of runs of each stage, the fastest of which is reported')
+  parser.add_argument('--skip-database', action='store_true',
+                      help='Query the embedded DuckDB engine instead of the database DB_CONNECTION_STRING points at')
+  parser.add_argument('--report', default=None, help='Path to write the JSON report to')
+  parser.add_argument('--compare', default=None, help='Path of an earlier JSON report to compare against')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as parquet_directory:
+    if args.data_directory is None:
+      write_exports(directory, args.events, args.users, args.max_devices, args.countries, args.text_format_fraction, args.days,
+                    seed=args.seed)
+    report = run(args, args.data_directory or directory, parquet_directory)
+  report['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+  if args.report is not None:
+    with open(args.report, 'w') as f:
+      json.dump(report, f, indent=2, default=str)
+    print('Wrote {}'.format(args.report))
+  if args.compare is not None:
+    with open(args.compare) as f:
+      print_comparison(report, json.load(f))
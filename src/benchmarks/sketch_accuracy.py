@@ -0,0 +1,109 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+import common
+from db_manager import get_dashboard_aggregates, get_sql_engine, get_total_monthly_users_by_country, query_to_dataframe
+from user_sketches import (SKETCH_ERROR, estimate_active_users, get_estimated_active_users, get_precision,
+                           update_user_sketches)
+
+'''
+  Compares the user counts estimated from the sketches in user_sketches.py against the exact counts, side by side.
+  The sketches are rebuilt with the given error first.
+  Usage: `python src/benchmarks/sketch_accuracy.py --error 0.02` (with `DB_CONNECTION_STRING` pointing at a loaded database)
+'''
+
+def get_exact_daily_users(engine) -> pd.DataFrame:
+  sql = sqlalchemy.sql.text("""
+                              SELECT CAST(time AS DATE) AS date, COUNT(DISTINCT user_id) AS count
+                              FROM action_events
+                              GROUP BY 1
+                              ORDER BY 1 ASC;
+                            """)
+  return query_to_dataframe(sql, engine)
+
+def get_exact_active_users(engine, start_date, end_date, countries: list) -> int:
+  sql = sqlalchemy.sql.text("""
+                              SELECT COUNT(DISTINCT events.user_id)
+                              FROM action_events events
+                              JOIN (
+                                SELECT user_id, MAX(country) AS country
+                                FROM users
+                                GROUP BY user_id
+                              ) countries ON countries.user_id = events.user_id
+                              WHERE CAST(events.time AS DATE) BETWEEN :start_date AND :end_date
+                              AND countries.country IN :countries;
+                            """).bindparams(sqlalchemy.bindparam('countries', expanding=True),
+                                            start_date=start_date, end_date=end_date, countries=countries)
+  with engine.connect() as connection:
+    return connection.execute(sql).scalar()
+
+def print_comparison(name: str, exact: pd.Series, estimated: pd.Series, error: float):
+  '''
+    Prints how far the estimates are from the exact counts, relative to the exact counts
+  '''
+  relative_errors = ((estimated - exact) / exact).abs()
+  print('{:<32} {:>6} {:>10.2%} {:>10.2%} {:>15.0%}'.format(
+    name, len(exact), relative_errors.mean(), relative_errors.max(), (relative_errors <= 2 * error).mean()))
+
+def run(error: float, show_months: bool):
+  engine = get_sql_engine()
+  connection = engine.raw_connection()
+  try:
+    start_time = time.perf_counter()
+    update_user_sketches(connection, error=error)
+    connection.commit()
+    print('Built sketches with {} registers in {:.2f}s'.format(1 << get_precision(error), time.perf_counter() - start_time))
+  finally:
+    connection.close()
+  with engine.connect() as connection:
+    sketch_bytes = connection.execute(sqlalchemy.sql.text('SELECT SUM(LENGTH(registers)) FROM user_sketches')).scalar()
+  print('Stored in {:,.0f} KB'.format(sketch_bytes / 1024))
+
+  exact_time = common.best_time(lambda: get_dashboard_aggregates(engine), 1)
+  estimate_time = common.best_time(lambda: get_estimated_active_users(engine), 1)
+  print('Monthly users: exact {:.3f}s, estimated {:.3f}s'.format(exact_time, estimate_time))
+
+  [total, new, _, _, _] = get_dashboard_aggregates(engine)
+  exact_monthly = total.set_index('date')[['count']].join(new.set_index('date')['count'].rename('new_count')).fillna(0)
+  exact_monthly['returning_count'] = exact_monthly['count'] - exact_monthly['new_count']
+  estimated_monthly = get_estimated_active_users(engine).set_index('date')
+  monthly = exact_monthly.join(estimated_monthly, rsuffix='_estimate')
+
+  exact_daily = get_exact_daily_users(engine).assign(date=lambda df: pd.to_datetime(df['date'])).set_index('date')
+  daily = exact_daily.join(get_estimated_active_users(engine, 'day').set_index('date'), rsuffix='_estimate')
+
+  by_country = get_total_monthly_users_by_country(engine)
+  by_country['date'] = pd.to_datetime(pd.DataFrame({'year': by_country['year'], 'month': by_country['month'], 'day': 1}))
+  country_estimates = pd.concat({country: get_estimated_active_users(engine, countries=[country]).set_index('date')['count']
+                                 for country in by_country['country'].unique()})
+  by_country = by_country.join(country_estimates.rename('count_estimate'), on=['country', 'date'])
+
+  # The users active over a whole quarter in half of the countries, which no single sketch covers
+  countries = sorted(by_country['country'].unique())[::2]
+  quarters = pd.period_range(total['date'].min(), total['date'].max(), freq='Q')
+  exact_quarters = pd.Series([get_exact_active_users(engine, q.start_time.date(), q.end_time.date(), countries) for q in quarters])
+  estimated_quarters = pd.Series([estimate_active_users(engine, q.start_time.date(), q.end_time.date(), countries) for q in quarters])
+
+  print('\nRelative error of the estimates (expected standard error {:.1%}):'.format(error))
+  print('{:<32} {:>6} {:>10} {:>10} {:>15}'.format('', 'count', 'mean', 'max', 'within 2 x error'))
+  print_comparison('Monthly active users', monthly['count'], monthly['count_estimate'], error)
+  print_comparison('Monthly new users', monthly['new_count'], monthly['new_count_estimate'], error)
+  print_comparison('Monthly returning users', monthly['returning_count'], monthly['returning_count_estimate'], error)
+  print_comparison('Daily active users', daily['count'], daily['count_estimate'], error)
+  print_comparison('Monthly active users by country', by_country['count'], by_country['count_estimate'], error)
+  print_comparison('Quarterly users in {} countries'.format(len(countries)), exact_quarters, estimated_quarters, error)
+
+  if show_months:
+    print()
+    print(monthly.astype(np.int64).to_string())
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compare the approximate user counts from sketches against exact counts.')
+  parser.add_argument('--error', type=float, default=SKETCH_ERROR, help='Relative standard error to build the sketches with')
+  parser.add_argument('--show-months', action='store_true', help='Print the exact and estimated counts of every month')
+  args = parser.parse_args()
+  run(args.error, args.show_months)
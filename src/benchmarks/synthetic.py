@@ -0,0 +1,164 @@
+import argparse
+import os
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+'''
+  Generates synthetic data matching the raw analytics and users exports.
+  Exports can be written at any scale for load_data.py and the benchmarks to read:
+  `python src/benchmarks/synthetic.py data --events 1000000 --users 50000`
+'''
+
+START_DATE = pd.Timestamp('2020-01-01', tz='UTC')
+
+def generate_timestamps(row_count: int, text_format_fraction: float = 0.5, days: int = 365, seed = 0) -> pd.Series:
+  '''
+    Generates timestamp strings as they appear in the raw exports, mixing both formats:
+      e.g. 'Sun Sep 27 2020 02:34:57 GMT+0000 (Coordinated Universal Time)'
+            and
+            '2020-09-26 23:30:04.947+00'
+    - text_format_fraction is the share of rows written in the first format
+    - seed seeds a new random generator, or is a generator (e.g. of the other columns of an export) to draw from,
+      so that the timestamps are independent of what else it generates
+  '''
+  rng = np.random.default_rng(seed)
+  offsets = pd.to_timedelta(rng.integers(0, days * 24 * 60 * 60 * 1000, row_count), unit='ms')
+  times = pd.Series(START_DATE + offsets)
+  text_dates = times.dt.strftime('%a %b %d %Y %H:%M:%S') + ' GMT+0000 (Coordinated Universal Time)'
+  iso_dates = times.dt.strftime('%Y-%m-%d %H:%M:%S.') + (times.dt.microsecond // 1000).astype(str).str.zfill(3) + '+00'
+  is_text_date = rng.random(row_count) < text_format_fraction
+  return text_dates.where(is_text_date, iso_dates)
+
+SCREENS = ['Home', 'Settings', 'Profile', 'Search', 'Help']
+ACTIONS = ['click', 'save', 'share', 'delete', 'login']
+COUNTRIES = ['CA', 'US', 'GB', 'DE', 'FR', 'JP', 'BR', 'IN', 'AU', 'MX', 'ES', 'IT', 'NL', 'SE', 'PL', 'CN', 'KR', 'RU',
+             'ZA', 'AR', 'CL', 'CO', 'EG', 'NG', 'KE', 'TR', 'SA', 'ID', 'TH', 'VN', 'PH', 'NZ', 'IE', 'PT', 'BE', 'CH',
+             'AT', 'DK', 'FI', 'UA']
+
+def generate_user_ids(user_count: int) -> np.ndarray:
+  '''
+    Generates `user_count` distinct user ids
+  '''
+  return np.char.add('user-', np.char.zfill(np.arange(user_count).astype(str), 8))
+
+def generate_analytics(row_count: int, user_count: int = 1000, screen_view_fraction: float = 0.5,
+                       text_format_fraction: float = 0.5, days: int = 365, seed: int = 0, country_count: int = 10) -> pd.DataFrame:
+  '''
+    Generates a raw analytics export with the columns of `data/example.analytics.csv`
+    - screen_view_fraction is the share of events that are page views rather than actions
+    - text_format_fraction is the share of timestamps written in the 'Sun Sep 27 2020 ...' format
+    - country_count is the number of COUNTRIES the events come from
+  '''
+  rng = np.random.default_rng(seed)
+  is_screen_view = rng.random(row_count) < screen_view_fraction
+  screens = np.array(SCREENS)[rng.integers(0, len(SCREENS), row_count)]
+  actions = np.array(ACTIONS)[rng.integers(0, len(ACTIONS), row_count)]
+  data = np.where(is_screen_view,
+                  np.char.add(np.char.add('{"screen": "', screens), '", "version": 1}'),
+                  np.char.add(np.char.add('{"action": "', actions), '", "version": 1}'))
+  user_ids = generate_user_ids(user_count)[rng.integers(0, user_count, row_count)]
+  return pd.DataFrame({
+    'type': np.where(is_screen_view, 'SCREEN_VIEW', 'ACTION'),
+    'time': generate_timestamps(row_count, text_format_fraction, days, rng),
+    'machine_id': np.char.add('machine-', user_ids),
+    'arch': 'x64',
+    'avail_ram': rng.integers(1, 32, row_count),
+    'country': np.array(COUNTRIES)[rng.integers(0, country_count, row_count)],
+    'data': data,
+    'duration': rng.integers(0, 10000, row_count),
+    'first_time': rng.random(row_count) < 0.01,
+    'locale': 'en-US',
+    'module_version': 1,
+    'os_version': '10.0',
+    'platform': 'win32',
+    'session_id': np.char.add('session-', rng.integers(0, row_count // 10 + 1, row_count).astype(str)),
+    'user_id': user_ids,
+    'version': '1.0.0',
+    'error_hash': np.nan,
+  })
+
+PLATFORMS = ['win32', 'darwin', 'linux']
+APP_VERSIONS = ['1.0.0', '1.1.0', '1.2.0', '2.0.0']
+
+def generate_users(user_count: int, max_devices: int = 3, text_format_fraction: float = 0.5, days: int = 365,
+                   seed: int = 0, country_count: int = 10) -> pd.DataFrame:
+  '''
+    Generates a raw users export with the columns of `data/example.users.csv`, with `max_devices` sets of
+    `devices.<n>.*` columns. Each user has between one and `max_devices` devices, the remaining columns are empty.
+    - text_format_fraction is the share of timestamps written in the 'Sun Sep 27 2020 ...' format
+    - country_count is the number of COUNTRIES the users come from
+  '''
+  rng = np.random.default_rng(seed)
+  device_counts = rng.integers(1, max_devices + 1, user_count)
+  users = {
+    '_id': np.char.add('id-', np.arange(user_count).astype(str)),
+    'appId': 'app',
+    'userId': generate_user_ids(user_count),
+    '__v': 0,
+    'createdAt': generate_timestamps(user_count, text_format_fraction, days, rng),
+  }
+  for n in range(max_devices):
+    has_device = device_counts > n
+    device_columns = {
+      'lastSeen': generate_timestamps(user_count, text_format_fraction, days, rng),
+      '_id': pd.Series(np.char.add('device-{}-'.format(n), np.arange(user_count).astype(str))),
+      'platform': pd.Series(np.array(PLATFORMS)[rng.integers(0, len(PLATFORMS), user_count)]),
+      'osVersion': pd.Series(rng.integers(7, 12, user_count)),
+      'version': pd.Series(np.array(APP_VERSIONS)[rng.integers(0, len(APP_VERSIONS), user_count)]),
+    }
+    for field, values in device_columns.items():
+      users['devices.{}.{}'.format(n, field)] = values.where(has_device)
+  users['props.country'] = np.array(COUNTRIES)[rng.integers(0, country_count, user_count)]
+  users['props.locale'] = 'en'
+  users['props.version'] = 1.0
+  users['updatedAt'] = generate_timestamps(user_count, text_format_fraction, days, rng)
+  return pd.DataFrame(users)
+
+# Number of events generated and written at a time, so that large exports are not held in memory
+WRITE_BATCH_SIZE = 1000000
+
+def write_exports(directory: str, event_count: int, user_count: int, max_devices: int = 3, country_count: int = 10,
+                  text_format_fraction: float = 0.5, days: int = 365, analytics_files: int = 1, name: str = 'synthetic',
+                  seed: int = 0) -> [List[str], str]:
+  '''
+    Writes a users export and `analytics_files` analytics exports sharing `event_count` events to `directory`,
+    named like the raw exports so that load_data.py picks them up, e.g. `analytics.synthetic.0.csv` and `users.synthetic.csv`.
+    Every event belongs to one of the `user_count` users.
+    Returns the paths of the analytics exports and of the users export.
+  '''
+  os.makedirs(directory, exist_ok=True)
+  analytics_paths = []
+  for i, file_event_count in enumerate(np.diff(np.linspace(0, event_count, analytics_files + 1).astype(int))):
+    path = os.path.join(directory, 'analytics.{}.{}.csv'.format(name, i))
+    for batch, start in enumerate(range(0, file_event_count, WRITE_BATCH_SIZE)):
+      batch_event_count = min(WRITE_BATCH_SIZE, file_event_count - start)
+      analytics = generate_analytics(batch_event_count, user_count, text_format_fraction=text_format_fraction, days=days,
+                                     seed=seed + i * 1000 + batch, country_count=country_count)
+      analytics.to_csv(path, mode='w' if batch == 0 else 'a', header=batch == 0, index=False)
+    analytics_paths.append(path)
+
+  users_path = os.path.join(directory, 'users.{}.csv'.format(name))
+  generate_users(user_count, max_devices, text_format_fraction, days, seed, country_count).to_csv(users_path, index=False)
+  return [analytics_paths, users_path]
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Write synthetic analytics and users exports.')
+  parser.add_argument('directory', help='Directory to write the exports to, e.g. data for load_data.py to load them')
+  parser.add_argument('--events', type=int, default=1000000, help='Number of events across all analytics exports')
+  parser.add_argument('--users', type=int, default=50000, help='Number of users')
+  parser.add_argument('--max-devices', type=int, default=3, help='Largest number of devices per user')
+  parser.add_argument('--countries', type=int, default=10, choices=range(1, len(COUNTRIES) + 1), metavar='[1-{}]'.format(len(COUNTRIES)),
+                      help='Number of countries users come from')
+  parser.add_argument('--text-format-fraction', type=float, default=0.5,
+                      help="Share of timestamps written in the 'Sun Sep 27 2020 ...' format rather than ISO 8601")
+  parser.add_argument('--days', type=int, default=365, help='Number of days the events are spread over')
+  parser.add_argument('--analytics-files', type=int, default=1, help='Number of analytics exports the events are split across')
+  parser.add_argument('--name', default='synthetic', help='Suffix of the export file names')
+  parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator, the same seed writes the same exports')
+  args = parser.parse_args()
+  [analytics_paths, users_path] = write_exports(args.directory, args.events, args.users, args.max_devices, args.countries,
+                                                args.text_format_fraction, args.days, args.analytics_files, args.name, args.seed)
+  for path in analytics_paths + [users_path]:
+    print('Wrote {} ({:,.1f} MB)'.format(path, os.path.getsize(path) / 2**20))
@@ -1,154 +1,820 @@
 import datetime
+import glob
+import io
 from dotenv import load_dotenv
 import os
+import threading
 import sqlalchemy
 import pandas as pd
 
 load_dotenv()
 
-def get_sql_engine() -> sqlalchemy.engine.base.Engine:
+# Connection strings starting with this select the EmbeddedEngine, followed by the directory holding the table files
+EMBEDDED_ENGINE_PREFIX = 'duckdb:///'
+
+def get_sql_engine():
   db_connection_string = os.getenv('DB_CONNECTION_STRING')
+  if db_connection_string.startswith(EMBEDDED_ENGINE_PREFIX):
+    return EmbeddedEngine(db_connection_string[len(EMBEDDED_ENGINE_PREFIX):])
   db_engine = sqlalchemy.create_engine(db_connection_string)
   return db_engine
 
+def get_sql_type(column: pd.Series) -> str:
+  '''
+    Returns the Postgres column type used to store a pandas column
+  '''
+  if isinstance(column.dtype, pd.DatetimeTZDtype):
+    return 'TIMESTAMP WITH TIME ZONE'
+  if pd.api.types.is_datetime64_any_dtype(column):
+    return 'TIMESTAMP WITHOUT TIME ZONE'
+  if pd.api.types.is_bool_dtype(column):
+    return 'BOOLEAN'
+  if pd.api.types.is_integer_dtype(column):
+    return 'BIGINT'
+  if pd.api.types.is_float_dtype(column):
+    return 'DOUBLE PRECISION'
+  return 'TEXT'
+
+def get_wider_sql_type(table_type: str, column_type: str) -> str:
+  '''
+    Returns the type a table column of `table_type` must be changed to so that it can also hold values of `column_type`
+    (both as returned by get_sql_type), or None if it can hold them already
+  '''
+  if table_type in (column_type, 'TEXT') or (table_type, column_type) == ('DOUBLE PRECISION', 'BIGINT'):
+    return None
+  if (table_type, column_type) == ('BIGINT', 'DOUBLE PRECISION'):
+    return 'DOUBLE PRECISION'
+  return 'TEXT'
+
+def add_missing_columns(df: pd.DataFrame, table_name: str, table_columns: dict, connection, schema: str = 'public'):
+  '''
+    Adds any columns of the DataFrame that are not in `table_columns` (the type of each column of an existing table,
+    see get_table_columns) to the table, and widens the type of columns that cannot hold the DataFrame's values,
+    e.g. columns created from a chunk in which they only had missing values.
+    `table_columns` is updated in place so that it keeps matching the table.
+  '''
+  with connection.cursor() as cursor:
+    for c in df.columns:
+      column_type = get_sql_type(df[c])
+      if c not in table_columns:
+        cursor.execute('ALTER TABLE {}."{}" ADD COLUMN "{}" {}'.format(schema, table_name, c, column_type))
+        table_columns[c] = column_type
+        continue
+      values = df[c].dropna()
+      wider_type = get_wider_sql_type(table_columns[c], column_type)
+      # Integers with missing values are floats in pandas, but are copied as integers (see copy_dataframe)
+      if wider_type == 'DOUBLE PRECISION' and (values % 1 == 0).all():
+        wider_type = None
+      if wider_type is not None and not values.empty:
+        cursor.execute('ALTER TABLE {0}."{1}" ALTER COLUMN "{2}" TYPE {3} USING "{2}"::{3}'.format(schema, table_name, c, wider_type))
+        table_columns[c] = wider_type
+
+def copy_dataframe(df: pd.DataFrame, table_name: str, connection, schema: str = 'public'):
+  '''
+    Bulk loads a DataFrame into an existing table with `COPY ... FROM STDIN`, which is much faster than
+    the row-by-row INSERTs sent by `DataFrame.to_sql`.
+    - connection is a raw DBAPI (psycopg2) connection, e.g. from `engine.raw_connection()`
+    Committing is left to the caller, so many chunks can be loaded in one transaction.
+  '''
+  if df.empty:
+    return
+  # Whole-number float columns (integers with missing values) must be written without a trailing '.0'
+  # or they will be rejected by integer columns
+  df = df.copy(deep=False)
+  for c in df.columns:
+    if pd.api.types.is_float_dtype(df[c]):
+      values = df[c].dropna()
+      if (values % 1 == 0).all():
+        df[c] = df[c].astype('Int64')
+  buffer = io.StringIO()
+  df.to_csv(buffer, index=False, header=False)
+  buffer.seek(0)
+  columns = ', '.join('"{}"'.format(c) for c in df.columns)
+  with connection.cursor() as cursor:
+    cursor.copy_expert('COPY {}."{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(schema, table_name, columns), buffer)
+
+def get_table_columns(table_name: str, connection, schema: str = 'public') -> dict:
+  '''
+    Returns the type of each column of an existing table, in the form returned by get_sql_type, or None if the table does not exist
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute('''
+                    SELECT column_name, UPPER(data_type) FROM information_schema.columns
+                    WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position
+                    ''', (schema, table_name))
+    columns = dict(cursor.fetchall())
+  return columns or None
+
+def get_key_expressions(table_name: str, key_columns: list, connection, schema: str = 'public') -> list:
+  '''
+    Returns the expressions rows of a table are matched on by `merge_dataframe`.
+    Missing values never match each other in a unique index, so missing text keys (e.g. events without a session)
+    are matched as empty strings, or rows with them would be inserted again every time they are loaded.
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute('SELECT column_name, data_type FROM information_schema.columns WHERE table_schema = %s AND table_name = %s',
+                   (schema, table_name))
+    column_types = dict(cursor.fetchall())
+  return ['(COALESCE("{}", \'\'))'.format(c) if column_types.get(c) == 'text' else '"{}"'.format(c) for c in key_columns]
+
+def create_unique_index(table_name: str, key_columns: list, connection, remove_duplicates: bool = False, schema: str = 'public'):
+  '''
+    Creates the unique index over `key_columns` that rows merged with `merge_dataframe` are matched on, unless it already exists.
+    Tables created without one, e.g. by a full load, may already hold rows with the same key, in which case a ValueError
+    listing some of their keys is raised, unless `remove_duplicates` is set to keep only the last copied row of each key.
+  '''
+  index_name = '{}_merge_key'.format(table_name)
+  with connection.cursor() as cursor:
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', ('{}."{}"'.format(schema, index_name),))
+    if cursor.fetchone()[0]:
+      return
+    key_expressions = ', '.join(get_key_expressions(table_name, key_columns, connection, schema))
+    cursor.execute('''
+      SELECT {2}, COUNT(*) - 1 AS extra_copies, SUM(COUNT(*) - 1) OVER () AS duplicate_count
+      FROM {0}."{1}"
+      GROUP BY {2}
+      HAVING COUNT(*) > 1
+      LIMIT 5'''.format(schema, table_name, key_expressions))
+    duplicates = cursor.fetchall()
+    if duplicates and not remove_duplicates:
+      raise ValueError('{}.{} holds {:,} rows with the same {} as another row, e.g. {}. '
+                       'Remove them (e.g. with `load_data.py --incremental --remove-duplicates`) before loading incrementally'.format(
+                         schema, table_name, duplicates[0][-1], key_columns, ', '.join(str(row[:-2]) for row in duplicates)))
+    if duplicates:
+      # Rows are identified by their partition and position in it, as tables may be partitioned
+      cursor.execute('''
+        DELETE FROM {0}."{1}" WHERE (tableoid, ctid) IN (
+          SELECT tableoid, ctid FROM (
+            SELECT tableoid, ctid, ROW_NUMBER() OVER (PARTITION BY {2} ORDER BY tableoid DESC, ctid DESC) AS copy_number
+            FROM {0}."{1}"
+          ) copies
+          WHERE copy_number > 1
+        )'''.format(schema, table_name, key_expressions))
+      print('Removed {:,} duplicate rows from {}.{}'.format(cursor.rowcount, schema, table_name))
+    cursor.execute('CREATE UNIQUE INDEX "{}" ON {}."{}" ({})'.format(index_name, schema, table_name, key_expressions))
+    # The index over the plain key columns that earlier loads created did not match rows with missing keys
+    cursor.execute('DROP INDEX IF EXISTS {}."{}_key"'.format(schema, table_name))
+
+def merge_dataframe(df: pd.DataFrame, table_name: str, key_columns: list, connection, update: bool = False, schema: str = 'public'):
+  '''
+    Bulk loads a DataFrame into an existing table, matching rows on `key_columns` (which need the unique index
+    created by `create_unique_index`). Rows that match an existing row are skipped, or update the existing row instead if `update` is set.
+    The rows are copied into a temporary staging table first, so the merge is a single INSERT ... ON CONFLICT.
+  '''
+  if df.empty:
+    return
+  df = df.drop_duplicates(subset=key_columns, keep='last')
+  staging_table_name = '{}_staging'.format(table_name)
+  columns = ', '.join('"{}"'.format(c) for c in df.columns)
+  update_columns = [c for c in df.columns if c not in key_columns]
+  if update and update_columns:
+    conflict_action = 'DO UPDATE SET ' + ', '.join('"{0}" = EXCLUDED."{0}"'.format(c) for c in update_columns)
+  else:
+    conflict_action = 'DO NOTHING'
+  key_expressions = ', '.join(get_key_expressions(table_name, key_columns, connection, schema))
+  with connection.cursor() as cursor:
+    cursor.execute('CREATE TEMPORARY TABLE "{}" (LIKE {}."{}")'.format(staging_table_name, schema, table_name))
+    copy_dataframe(df, staging_table_name, connection, schema='pg_temp')
+    cursor.execute('INSERT INTO {0}."{1}" ({2}) SELECT {2} FROM pg_temp."{3}" ON CONFLICT ({4}) {5}'.format(
+      schema, table_name, columns, staging_table_name, key_expressions, conflict_action))
+    cursor.execute('DROP TABLE pg_temp."{}"'.format(staging_table_name))
+
+def create_index(table_name: str, columns: list, connection, schema: str = 'public'):
+  '''
+    Creates an index over `columns`, named after the table and columns, unless it already exists
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute('CREATE INDEX IF NOT EXISTS "{0}_{1}" ON {2}."{0}" ({3})'.format(
+      table_name, '_'.join(columns), schema, ', '.join('"{}"'.format(c) for c in columns)))
+
+def create_table(df: pd.DataFrame, table_name: str, connection, partition_column: str = None, replace: bool = False, schema: str = 'public'):
+  '''
+    Creates a table with the columns of a DataFrame over `connection`, so that it is created (or replaced) in the same
+    transaction as the rows loaded into it.
+    - partition_column is a datetime column the table is partitioned by ranges of. Partitions are added by
+      create_month_partitions as rows are loaded, and queries comparing `partition_column` against constants
+      only read the partitions that can hold matching rows.
+    - replace drops any existing table first, otherwise an existing table is kept as it is
+  '''
+  columns = ', '.join('"{}" {}'.format(c, get_sql_type(df[c])) for c in df.columns)
+  partitioning = '' if partition_column is None else ' PARTITION BY RANGE ("{}")'.format(partition_column)
+  with connection.cursor() as cursor:
+    if replace:
+      cursor.execute('DROP TABLE IF EXISTS {}."{}" CASCADE'.format(schema, table_name))
+    cursor.execute('CREATE TABLE IF NOT EXISTS {}."{}" ({}){}'.format(schema, table_name, columns, partitioning))
+
+def create_month_partitions(times: pd.Series, table_name: str, connection, schema: str = 'public'):
+  '''
+    Adds a partition for each month (in UTC) of `times` that a partitioned table (see create_table) does not have yet.
+    Tables that are not partitioned are left as they are.
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", ('{}."{}"'.format(schema, table_name),))
+    is_partitioned = cursor.fetchone()
+    if not is_partitioned or not is_partitioned[0]:
+      return
+    for month in times.dropna().dt.tz_convert(None).dt.to_period('M').unique():
+      cursor.execute('CREATE TABLE IF NOT EXISTS {0}."{1}_{2:%Y_%m}" PARTITION OF {0}."{1}" FOR VALUES FROM (%s) TO (%s)'.format(
+        schema, table_name, month.start_time), (month.start_time.tz_localize('UTC'), (month + 1).start_time.tz_localize('UTC')))
+
+# Event tables written to Parquet are partitioned into one directory per month of their events, e.g. `year=2020/month=9`
+PARQUET_PARTITION_COLUMNS = ['year', 'month']
+
+def to_arrow_table(df: pd.DataFrame):
+  '''
+    Converts a DataFrame to an Arrow table, storing text columns as dictionary-encoded strings.
+    Text columns always get the same type, even when a chunk has no values for them, so that files can be read together.
+  '''
+  import pyarrow as pa
+  columns = {}
+  for c in df.columns:
+    if pd.api.types.is_object_dtype(df[c]) or isinstance(df[c].dtype, pd.CategoricalDtype):
+      values = df[c].astype(object).map(str, na_action='ignore')
+      columns[c] = pa.array(values, type=pa.string(), from_pandas=True).dictionary_encode()
+    else:
+      columns[c] = pa.array(df[c], from_pandas=True)
+  return pa.table(columns)
+
+def write_parquet_table(df: pd.DataFrame, table_name: str, directory: str, basename: str, partition_column: str = None):
+  '''
+    Writes a DataFrame to the `<directory>/<table_name>` Parquet dataset, in files named after `basename`.
+    - partition_column is a UTC datetime column whose year and month the rows are partitioned by, see PARQUET_PARTITION_COLUMNS
+    Files written earlier with the same `basename` are overwritten, so writing the same data again does not duplicate it.
+  '''
+  import pyarrow as pa
+  import pyarrow.dataset as ds
+  if df.empty:
+    return
+  partitioning = None
+  if partition_column is not None:
+    df = df.assign(year=df[partition_column].dt.year.astype('int32'), month=df[partition_column].dt.month.astype('int32'))
+    partitioning = ds.partitioning(pa.schema([(c, pa.int32()) for c in PARQUET_PARTITION_COLUMNS]), flavor='hive')
+  ds.write_dataset(to_arrow_table(df), os.path.join(directory, table_name), format='parquet', partitioning=partitioning,
+                   basename_template=basename + '-{i}.parquet', existing_data_behavior='overwrite_or_ignore',
+                   file_options=ds.ParquetFileFormat().make_write_options(compression='zstd', use_dictionary=True))
+
+def get_month_filter(start_date: datetime.date = None, end_date: datetime.date = None):
+  '''
+    Returns an Arrow expression that keeps the months from the month of `start_date` to the month of `end_date`, or None
+  '''
+  import pyarrow.dataset as ds
+  year, month = ds.field('year'), ds.field('month')
+  month_filter = None
+  if start_date is not None:
+    month_filter = (year > start_date.year) | ((year == start_date.year) & (month >= start_date.month))
+  if end_date is not None:
+    end_filter = (year < end_date.year) | ((year == end_date.year) & (month <= end_date.month))
+    month_filter = end_filter if month_filter is None else month_filter & end_filter
+  return month_filter
+
+def read_parquet_table(directory: str, table_name: str, columns: list = None,
+                       start_date: datetime.date = None, end_date: datetime.date = None) -> pd.DataFrame:
+  '''
+    Reads a table written by write_parquet_table, only opening the files and columns that are needed.
+    - columns to read, which may include the partition columns, or every column if not given
+    - start_date and end_date limit a partitioned table to the months from the month of `start_date` to the month of `end_date`
+    Files written from different chunks may not all have the same columns, missing columns are read as missing values.
+  '''
+  import pyarrow as pa
+  import pyarrow.dataset as ds
+  path = os.path.join(directory, table_name)
+  is_partitioned = any(name.startswith(PARQUET_PARTITION_COLUMNS[0] + '=') for name in os.listdir(path))
+  partitioning = None
+  if is_partitioned:
+    partitioning = ds.partitioning(pa.schema([(c, pa.int32()) for c in PARQUET_PARTITION_COLUMNS]), flavor='hive')
+  month_filter = get_month_filter(start_date, end_date) if is_partitioned else None
+
+  # Months outside the range are skipped by their directory names, without opening their files
+  fragments = list(ds.dataset(path, format='parquet', partitioning=partitioning).get_fragments(filter=month_filter))
+  if not fragments:
+    return pd.DataFrame(columns=columns)
+  schema = pa.unify_schemas([f.physical_schema for f in fragments], promote_options='permissive')
+  if is_partitioned:
+    schema = pa.unify_schemas([schema, partitioning.schema])
+  dataset = ds.dataset([f.path for f in fragments], schema=schema, format='parquet',
+                       partitioning=partitioning, partition_base_dir=path)
+  return dataset.to_table(columns=columns, filter=month_filter).to_pandas()
+
+def get_monthly_users_from_parquet(directory: str, start_date: datetime.date = None, end_date: datetime.date = None) -> [pd.DataFrame, pd.DataFrame]:
+  '''
+    Computes the same DataFrames as get_total_monthly_users and get_total_monthly_users_by_country from a Parquet
+    dataset written by `load_data.py --parquet-directory`, for the months from `start_date` to `end_date`.
+    The year and month of each event come from the partition directories, so only the user_id column of the
+    action_events files for those months and the country of each user are read.
+  '''
+  user_months = (read_parquet_table(directory, 'action_events', ['user_id', 'year', 'month'], start_date, end_date)
+                  .astype({'user_id': object})
+                  .drop_duplicates())
+  if os.path.isdir(os.path.join(directory, 'users')):
+    countries = read_parquet_table(directory, 'users', ['user_id', 'country']).astype(object).groupby('user_id')['country'].max()
+    user_months['country'] = user_months['user_id'].map(countries)
+  else:
+    user_months['country'] = None
+
+  total_monthly_users = to_compact_dtypes(user_months.groupby(['year', 'month'], as_index=False, sort=True)
+                                           .size().rename(columns={'size': 'count'}))
+  add_month_start_dates(total_monthly_users)
+  total_monthly_users_by_country = to_compact_dtypes(user_months.dropna(subset=['country'])
+                                                      .groupby(['year', 'month', 'country'], as_index=False, sort=True)
+                                                      .size().rename(columns={'size': 'count'}))
+  return [total_monthly_users, total_monthly_users_by_country]
+
+# Compact dtypes for the columns returned by the dashboard queries
+COLUMN_DTYPES = {
+  'year': 'int16',
+  'month': 'int16',
+  'country': 'category',
+  'count': 'int32',
+  'new_count': 'int32',
+}
+# Number of rows fetched from the database at a time
+FETCH_BATCH_SIZE = 10000
+
 def query_to_dataframe(sql: sqlalchemy.sql.text, engine = None) -> pd.DataFrame:
+  '''
+    Runs a query and returns its results as a DataFrame.
+    Rows are streamed from a server-side cursor in batches of FETCH_BATCH_SIZE, each of which is converted to
+    columns straight away, so the full result is never held as Python tuples.
+    Columns listed in COLUMN_DTYPES are converted to their compact dtype.
+  '''
   if engine is None:
     engine = get_sql_engine()
-  results = engine.execute(sql)
-  df = pd.DataFrame(results.fetchall())
-  df.columns = results.keys()
+  if isinstance(engine, EmbeddedEngine):
+    return to_compact_dtypes(engine.query(sql))
+  batches = []
+  with engine.connect() as connection:
+    results = connection.execution_options(stream_results=True).execute(sql)
+    columns = list(results.keys())
+    rows = results.fetchmany(FETCH_BATCH_SIZE)
+    while rows:
+      batches.append(to_compact_dtypes(pd.DataFrame.from_records(rows, columns=columns), exclude=('country',)))
+      rows = results.fetchmany(FETCH_BATCH_SIZE)
+  if not batches:
+    return to_compact_dtypes(pd.DataFrame(columns=columns))
+  # Categories are only assigned once all batches are combined, so that they share the same categories
+  return to_compact_dtypes(pd.concat(batches, ignore_index=True))
+
+def to_compact_dtypes(df: pd.DataFrame, exclude: tuple = ()) -> pd.DataFrame:
+  '''
+    Converts columns listed in COLUMN_DTYPES to their compact dtype, leaving columns with missing numbers as they are
+  '''
+  for column, dtype in COLUMN_DTYPES.items():
+    if column not in df.columns or column in exclude:
+      continue
+    if dtype != 'category' and df[column].isna().any():
+      continue
+    df[column] = df[column].astype(dtype)
   return df
 
-def get_total_monthly_users(engine = None) -> pd.DataFrame:
+def add_month_start_dates(df: pd.DataFrame) -> pd.DataFrame:
+  '''
+    Adds a `date` column with the first day of each row's `year` and `month`
+  '''
+  df['date'] = pd.to_datetime(pd.DataFrame({'year': df['year'], 'month': df['month'], 'day': 1}))
+  return df
+
+# Lengths of the periods users can be counted in, as understood by date_trunc in both Postgres and DuckDB
+GRANULARITIES = ['day', 'week', 'month']
+
+def get_period_start(date: datetime.date, granularity: str) -> datetime.date:
+  '''
+    Returns the first day of the period containing `date`. Weeks start on Mondays, as they do for date_trunc.
+  '''
+  if granularity == 'day':
+    return date
+  if granularity == 'week':
+    return date - datetime.timedelta(days=date.weekday())
+  if granularity == 'month':
+    return date.replace(day=1)
+  raise ValueError('Unknown granularity {}, expected one of {}'.format(granularity, GRANULARITIES))
+
+def get_period_end(date: datetime.date, granularity: str) -> datetime.date:
+  '''
+    Returns the first day of the period after the one containing `date`
+  '''
+  period_start = get_period_start(date, granularity)
+  if granularity == 'day':
+    return period_start + datetime.timedelta(days=1)
+  if granularity == 'week':
+    return period_start + datetime.timedelta(days=7)
+  return (period_start + datetime.timedelta(days=32)).replace(day=1)
+
+def get_month_conditions(start_date: datetime.date = None, end_date: datetime.date = None) -> [list, dict]:
+  '''
+    Returns the conditions (and their parameters) keeping the rows of user_month_activity from the month of
+    `start_date` to the month of `end_date`
+  '''
+  conditions = []
+  parameters = {}
+  if start_date is not None:
+    conditions.append('(year > :start_year OR (year = :start_year AND month >= :start_month))')
+    parameters.update(start_year=start_date.year, start_month=start_date.month)
+  if end_date is not None:
+    conditions.append('(year < :end_year OR (year = :end_year AND month <= :end_month))')
+    parameters.update(end_year=end_date.year, end_month=end_date.month)
+  return [conditions, parameters]
+
+def get_time_conditions(start_date: datetime.date = None, end_date: datetime.date = None, granularity: str = 'day') -> [list, dict]:
+  '''
+    Returns the conditions (and their parameters) keeping the events from the start of the period containing `start_date`
+    to the end of the period containing `end_date`.
+    Both compare the bare time column against a constant, so they can be answered from the index on action_events.time
+    (and only read the partitions of those months) instead of computing the date of every event.
+  '''
+  conditions = []
+  parameters = {}
+  if start_date is not None:
+    conditions.append('time >= :start_time')
+    parameters['start_time'] = datetime.datetime.combine(get_period_start(start_date, granularity), datetime.time())
+  if end_date is not None:
+    conditions.append('time < :end_time')
+    parameters['end_time'] = datetime.datetime.combine(get_period_end(end_date, granularity), datetime.time())
+  return [conditions, parameters]
+
+def get_where_clause(conditions: list) -> str:
+  return 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+# The months each user was active in
+# The rollup queries are written in SQL that Postgres and the EmbeddedEngine (DuckDB) both run unchanged
+USER_MONTHS_SQL = """
+                  SELECT DISTINCT
+                    user_id,
+                    CAST(EXTRACT(year FROM time) AS INT) AS year,
+                    CAST(EXTRACT(month FROM time) AS INT) AS month
+                  FROM action_events
+                  """
+# The whole user_month_activity rollup, as maintained by update_user_month_activity
+USER_MONTH_ACTIVITY_SQL = """
+                          SELECT
+                            months.user_id,
+                            months.year,
+                            months.month,
+                            countries.country,
+                            months.year * 12 + months.month = MIN(months.year * 12 + months.month) OVER (PARTITION BY months.user_id) AS first_active_month
+                          FROM ({}) months
+                          LEFT JOIN (
+                            SELECT user_id, MAX(country) AS country
+                            FROM users
+                            GROUP BY user_id
+                          ) countries ON countries.user_id = months.user_id
+                          """.format(USER_MONTHS_SQL)
+
+def update_user_month_activity(connection, since: datetime.datetime = None, rebuild: bool = False):
+  '''
+    Maintains the user_month_activity rollup, which has one row per user per month they were active in,
+    along with their country and whether it was the first month they were active in.
+    All dashboard queries read from this table instead of scanning every event.
+    - since adds the months of events at or after this time, which is all that changes after an incremental load
+    - rebuild recomputes the table from all of action_events instead
+    The country of every user is refreshed either way, so loading only a users export keeps the table up to date.
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute("SELECT to_regclass('public.action_events') IS NULL, to_regclass('public.users') IS NULL, to_regclass('public.user_month_activity') IS NULL")
+    [no_events, no_users, no_rollup] = cursor.fetchone()
+    if no_events:
+      return
+    rebuild = rebuild or no_rollup
+    cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS public.user_month_activity (
+                      user_id TEXT NOT NULL,
+                      year INT NOT NULL,
+                      month INT NOT NULL,
+                      country TEXT,
+                      first_active_month BOOLEAN NOT NULL DEFAULT FALSE,
+                      PRIMARY KEY (user_id, year, month)
+                    )
+                    """)
+    # Supports limiting the dashboard queries to a range of months
+    cursor.execute('CREATE INDEX IF NOT EXISTS user_month_activity_year_month ON public.user_month_activity (year, month)')
+    if rebuild:
+      cursor.execute('TRUNCATE public.user_month_activity')
+    if rebuild or since is not None:
+      cursor.execute("""
+                      INSERT INTO public.user_month_activity (user_id, year, month)
+                      {}
+                      WHERE %(rebuild)s OR time >= %(since)s
+                      ON CONFLICT DO NOTHING
+                      """.format(USER_MONTHS_SQL), {'rebuild': rebuild, 'since': since})
+      # Only users active since `since` can have gained an earlier first month
+      cursor.execute("""
+                      UPDATE public.user_month_activity activity
+                      SET first_active_month = (activity.year * 12 + activity.month = first_months.first_month)
+                      FROM (
+                        SELECT user_id, MIN(year * 12 + month) AS first_month
+                        FROM public.user_month_activity
+                        WHERE %(rebuild)s OR user_id IN (
+                          SELECT user_id
+                          FROM public.user_month_activity
+                          WHERE year * 12 + month >= %(since_month)s
+                        )
+                        GROUP BY user_id
+                      ) first_months
+                      WHERE activity.user_id = first_months.user_id
+                      """, {'rebuild': rebuild, 'since_month': since.year * 12 + since.month if since is not None else None})
+    if no_users:
+      return
+    cursor.execute("""
+                    UPDATE public.user_month_activity activity
+                    SET country = u.country
+                    FROM users u
+                    WHERE activity.user_id = u.user_id
+                    AND activity.country IS DISTINCT FROM u.country
+                    """)
+
+def get_total_monthly_users(engine = None, start_date: datetime.date = None, end_date: datetime.date = None) -> pd.DataFrame:
+  [conditions, parameters] = get_month_conditions(start_date, end_date)
   sql = sqlalchemy.sql.text("""
                               SELECT
                                 year,
                                 month,
-                                COUNT(*)
-                              FROM (
-                                SELECT DISTINCT 
-                                  user_id,
-                                  EXTRACT(year FROM time)::int AS year, 
-                                  EXTRACT(month FROM time)::int AS month
-                                FROM action_events 
-                              ) monthly_active_users
+                                COUNT(*) AS count
+                              FROM user_month_activity
+                              {}
                               GROUP BY year, month
                               ORDER BY year, month ASC;
-                            """)
+                            """.format(get_where_clause(conditions))).bindparams(**parameters)
   total_monthly_users = query_to_dataframe(sql, engine)
-  total_monthly_users['date'] = total_monthly_users.apply(lambda row: datetime.date(row['year'], row['month'], 1), axis=1)
+  add_month_start_dates(total_monthly_users)
   return total_monthly_users
 
-def get_total_new_monthly_users(engine = None) -> pd.DataFrame:
+def get_total_new_monthly_users(engine = None, start_date: datetime.date = None, end_date: datetime.date = None) -> pd.DataFrame:
+  [conditions, parameters] = get_month_conditions(start_date, end_date)
   sql = sqlalchemy.sql.text("""
-                              SELECT year, month, COUNT(*)
-                              FROM (
-                                SELECT
-                                user_id,
-                                min(year) AS year,
-                                min(month) AS month
-                                FROM (
-                                  SELECT DISTINCT 
-                                  user_id,
-                                  EXTRACT(year FROM time)::int AS year, 
-                                  EXTRACT(month FROM time)::int AS month
-                                  FROM action_events 
-                                ) monthly_active_users
-                                GROUP BY user_id
-                              ) monthly_new_users
-                                GROUP BY year, month
-                                ORDER BY year, month ASC;
-                            """)
+                              SELECT year, month, COUNT(*) AS count
+                              FROM user_month_activity
+                              {}
+                              GROUP BY year, month
+                              ORDER BY year, month ASC;
+                            """.format(get_where_clause(['first_active_month'] + conditions))).bindparams(**parameters)
   total_new_monthly_users = query_to_dataframe(sql, engine)
-  total_new_monthly_users['date'] = total_new_monthly_users.apply(lambda row: datetime.date(row['year'], row['month'], 1), axis=1)
+  add_month_start_dates(total_new_monthly_users)
   return total_new_monthly_users
 
-def get_total_returning_monthly_users(engine = None) -> pd.DataFrame:
+def get_total_returning_monthly_users(engine = None, start_date: datetime.date = None, end_date: datetime.date = None) -> pd.DataFrame:
+  [conditions, parameters] = get_month_conditions(start_date, end_date)
   sql = sqlalchemy.sql.text("""
                               SELECT 
                                 year,
                                 month,
-                                COUNT(*)
-                              FROM 
-                              (
-                                (
-                                  SELECT DISTINCT 
-                                    user_id,
-                                    EXTRACT(year FROM time)::int AS year, 
-                                    EXTRACT(month FROM time)::int AS month
-                                  FROM action_events 
-                                )
-                                EXCEPT
-                                (SELECT
-                                  user_id,
-                                  min(year) AS year,
-                                  min(month) AS month
-                                  FROM (
-                                    SELECT DISTINCT 
-                                    user_id,
-                                    EXTRACT(year FROM time)::int AS year, 
-                                    EXTRACT(month FROM time)::int AS month
-                                    FROM action_events 
-                                  ) monthly_active_users
-                                  GROUP BY user_id
-                                )
-                              ) returning_users_by_month
+                                COUNT(*) AS count
+                              FROM user_month_activity
+                              {}
                               GROUP BY year, month
                               ORDER BY year, month ASC;
-                            """)
+                            """.format(get_where_clause(['NOT first_active_month'] + conditions))).bindparams(**parameters)
   total_returning_monthly_users = query_to_dataframe(sql, engine)
-  total_returning_monthly_users['date'] = total_returning_monthly_users.apply(lambda row: datetime.date(row['year'], row['month'], 1), axis=1)
+  add_month_start_dates(total_returning_monthly_users)
   return total_returning_monthly_users
 
-
-
-def get_total_new_monthly_users_by_country(engine = None) -> pd.DataFrame:
+def get_total_new_monthly_users_by_country(engine = None, start_date: datetime.date = None, end_date: datetime.date = None) -> pd.DataFrame:
+  [conditions, parameters] = get_month_conditions(start_date, end_date)
   sql = sqlalchemy.sql.text("""
-                              SELECT year, month, country, COUNT(*)
-                              FROM (
-                                SELECT
-                                user_id,
-                                country,
-                                min(year) AS year,
-                                min(month) AS month
-                                FROM (
-                                  SELECT DISTINCT 
-                                  u.user_id,
-                                  u.country,
-                                  EXTRACT(year FROM time)::int AS year, 
-                                  EXTRACT(month FROM time)::int AS month
-                                  FROM action_events evt
-                                  JOIN users u
-                                  ON evt.user_id = u.user_id
-                                ) monthly_active_users
-                                GROUP BY user_id, country
-                              ) monthly_new_users
-                                GROUP BY year, month, country
-                                ORDER BY year, month ASC;
-                            """)
+                              SELECT year, month, country, COUNT(*) AS count
+                              FROM user_month_activity
+                              {}
+                              GROUP BY year, month, country
+                              ORDER BY year, month, country ASC;
+                            """.format(get_where_clause(['first_active_month', 'country IS NOT NULL'] + conditions))).bindparams(**parameters)
   total_new_monthly_users_by_country = query_to_dataframe(sql, engine)
   return total_new_monthly_users_by_country
 
-def get_total_monthly_users_by_country(engine = None) -> pd.DataFrame:
+def get_total_monthly_users_by_country(engine = None, start_date: datetime.date = None, end_date: datetime.date = None) -> pd.DataFrame:
+  [conditions, parameters] = get_month_conditions(start_date, end_date)
   sql = sqlalchemy.sql.text("""
                               SELECT
                                 year,
                                 month,
                                 country,
-                                COUNT(*)
-                              FROM (
-                                SELECT DISTINCT 
-                                  u.user_id,
+                                COUNT(*) AS count
+                              FROM user_month_activity
+                              {}
+                              GROUP BY year, month, country
+                              ORDER BY year, month, country ASC;
+                            """.format(get_where_clause(['country IS NOT NULL'] + conditions))).bindparams(**parameters)
+  total_monthly_users_by_country = query_to_dataframe(sql, engine)
+  return total_monthly_users_by_country
+
+def get_user_activity_counts(engine = None, granularity: str = 'month', start_date: datetime.date = None,
+                             end_date: datetime.date = None) -> pd.DataFrame:
+  '''
+    Counts the users active in each period (see GRANULARITIES) in each country, along with how many of them were
+    first active in that period, from the period containing `start_date` to the period containing `end_date`.
+    Returns the columns date (the first day of each period), country, count and new_count, ordered by date and country.
+    Months are counted from the user_month_activity rollup. Days and weeks are counted from the events in the range,
+    with only the users first active in the range checked for earlier events.
+  '''
+  if granularity == 'month':
+    [conditions, parameters] = get_month_conditions(start_date, end_date)
+    sql = sqlalchemy.sql.text("""
+                                SELECT
+                                  year,
+                                  month,
                                   country,
-                                  EXTRACT(year FROM time)::int AS year, 
-                                  EXTRACT(month FROM time)::int AS month
-                                  FROM action_events evt
-                                  JOIN users u
-                                  ON evt.user_id = u.user_id
-                                ) monthly_active_users
+                                  COUNT(*) AS count,
+                                  SUM(CASE WHEN first_active_month THEN 1 ELSE 0 END) AS new_count
+                                FROM user_month_activity
+                                {}
                                 GROUP BY year, month, country
-                                ORDER BY year, month ASC;
+                                ORDER BY year, month, country ASC;
+                              """.format(get_where_clause(conditions))).bindparams(**parameters)
+    return add_month_start_dates(query_to_dataframe(sql, engine))
+
+  [conditions, parameters] = get_time_conditions(start_date, end_date, granularity)
+  # Users first active in the range are only new if they had no events before it
+  no_earlier_events = '' if start_date is None else """
+                                                    AND NOT EXISTS (
+                                                      SELECT 1
+                                                      FROM action_events earlier
+                                                      WHERE earlier.user_id = periods.user_id
+                                                      AND earlier.time < :start_time
+                                                    )
+                                                    """
+  sql = sqlalchemy.sql.text("""
+                              SELECT
+                                periods.date,
+                                countries.country,
+                                COUNT(*) AS count,
+                                SUM(CASE WHEN periods.first_period {} THEN 1 ELSE 0 END) AS new_count
+                              FROM (
+                                SELECT
+                                  user_id,
+                                  date,
+                                  date = MIN(date) OVER (PARTITION BY user_id) AS first_period
+                                FROM (
+                                  SELECT DISTINCT user_id, CAST(date_trunc('{}', time) AS DATE) AS date
+                                  FROM action_events
+                                  {}
+                                ) user_periods
+                              ) periods
+                              LEFT JOIN (
+                                SELECT user_id, MAX(country) AS country
+                                FROM users
+                                GROUP BY user_id
+                              ) countries ON countries.user_id = periods.user_id
+                              GROUP BY periods.date, countries.country
+                              ORDER BY periods.date, countries.country ASC;
+                            """.format(no_earlier_events, granularity, get_where_clause(conditions))).bindparams(**parameters)
+  counts = query_to_dataframe(sql, engine)
+  counts['date'] = pd.to_datetime(counts['date'])
+  return counts
+
+def get_dashboard_aggregates(engine = None, start_date: datetime.date = None, end_date: datetime.date = None,
+                             granularity: str = 'month') -> [pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+  '''
+    Computes every dashboard aggregate from a single query (see get_user_activity_counts).
+    Each user is counted once per period in one country, so the totals are the sums of the per-country counts.
+    - start_date and end_date limit the aggregates to the periods containing them and those in between
+    - granularity is the length of the periods, see GRANULARITIES
+    Every DataFrame has a date column with the first day of each period, monthly ones also have year and month columns.
+    For months, returns the same DataFrames as, in order:
+      get_total_monthly_users, get_total_new_monthly_users, get_total_returning_monthly_users,
+      get_total_monthly_users_by_country and get_total_new_monthly_users_by_country
+  '''
+  counts = get_user_activity_counts(engine, granularity, start_date, end_date)
+  counts['returning_count'] = counts['count'] - counts['new_count']
+  period_columns = ['year', 'month', 'date'] if granularity == 'month' else ['date']
+
+  period_counts = counts.groupby(period_columns, as_index=False, sort=True)[['count', 'new_count', 'returning_count']].sum()
+  period_counts = to_compact_dtypes(period_counts.astype({'count': 'int32', 'new_count': 'int32', 'returning_count': 'int32'}))
+  total_users = period_counts[period_columns + ['count']]
+  total_new_users = (period_counts.loc[period_counts['new_count'] > 0, period_columns + ['new_count']]
+                      .rename(columns={'new_count': 'count'}).reset_index(drop=True))
+  total_returning_users = (period_counts.loc[period_counts['returning_count'] > 0, period_columns + ['returning_count']]
+                            .rename(columns={'returning_count': 'count'}).reset_index(drop=True))
+
+  country_counts = counts[counts['country'].notna()]
+  total_users_by_country = country_counts[period_columns + ['country', 'count']].reset_index(drop=True)
+  total_new_users_by_country = (country_counts.loc[country_counts['new_count'] > 0, period_columns + ['country', 'new_count']]
+                                 .rename(columns={'new_count': 'count'}).reset_index(drop=True))
+
+  return [total_users, total_new_users, total_returning_users,
+          total_users_by_country, total_new_users_by_country]
+
+def get_data_version(engine = None) -> str:
+  '''
+    Returns a token that changes whenever data is loaded into the database, which cached query results are keyed on.
+    Every load is recorded in the ingestion log, so this is cheap to compute; databases loaded before the log
+    existed fall back to the size and latest month of the user_month_activity rollup.
+  '''
+  if engine is None:
+    engine = get_sql_engine()
+  if isinstance(engine, EmbeddedEngine):
+    return engine.get_data_version()
+  with engine.connect() as connection:
+    if engine.dialect.has_table(connection, 'ingested_files'):
+      sql = 'SELECT COUNT(*), MAX(loaded_at), MAX(max_event_time) FROM ingested_files'
+    else:
+      sql = 'SELECT COUNT(*), MAX(year * 100 + month) FROM user_month_activity'
+    version = connection.execute(sqlalchemy.sql.text(sql)).fetchone()
+  return '|'.join(str(v) for v in version)
+
+def get_ingestion_log(engine = None) -> pd.DataFrame:
+  '''
+    Returns the files recorded in the ingestion log, in the order they were loaded
+  '''
+  if engine is None:
+    engine = get_sql_engine()
+  # Local table files are not loaded by load_data.py, so they have no ingestion log
+  if isinstance(engine, EmbeddedEngine):
+    return pd.DataFrame(columns=['file_name', 'row_count', 'min_event_time', 'max_event_time', 'loaded_at'])
+  with engine.connect() as connection:
+    if not engine.dialect.has_table(connection, 'ingested_files'):
+      return pd.DataFrame(columns=['file_name', 'row_count', 'min_event_time', 'max_event_time', 'loaded_at'])
+  sql = sqlalchemy.sql.text("""
+                              SELECT file_name, row_count, min_event_time, max_event_time, loaded_at
+                              FROM ingested_files
+                              ORDER BY loaded_at ASC;
                             """)
-  total_monthly_users_by_country = query_to_dataframe(sql, engine)
-  return total_monthly_users_by_country
-  
\ No newline at end of file
+  return query_to_dataframe(sql, engine)
+
+# Tables the EmbeddedEngine reads from local files
+EMBEDDED_TABLES = ['action_events', 'page_events', 'users', 'devices']
+
+class EmbeddedEngine:
+  '''
+    Runs the dashboard queries with DuckDB, an embedded columnar database, over tables stored as local files,
+    so the dashboard can be built without a database server. It is used instead of Postgres when
+    `DB_CONNECTION_STRING` is `duckdb:///<directory>`, where the directory holds each table as `<table>.parquet`,
+    `<table>.csv` or a `<table>` directory of Parquet files (see export_tables.py).
+    The user_month_activity rollup is computed in memory with USER_MONTH_ACTIVITY_SQL, and again whenever the files change.
+  '''
+  def __init__(self, directory: str):
+    self.directory = directory
+    self.url = EMBEDDED_ENGINE_PREFIX + directory
+    self.connection = None
+    self.data_version = None
+    self.lock = threading.Lock()
+
+  def get_table_files(self) -> dict:
+    '''
+      Returns the files of each table found in the directory, along with the DuckDB expression that reads them
+    '''
+    tables = {}
+    for table_name in EMBEDDED_TABLES:
+      path = os.path.join(self.directory, table_name)
+      quoted_path = path.replace("'", "''")
+      if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True))
+        reader = "read_parquet('{}/**/*.parquet', hive_partitioning = true, union_by_name = true)".format(quoted_path)
+      elif os.path.exists(path + '.parquet'):
+        files = [path + '.parquet']
+        reader = "read_parquet('{}.parquet')".format(quoted_path)
+      elif os.path.exists(path + '.csv'):
+        files = [path + '.csv']
+        reader = "read_csv_auto('{}.csv')".format(quoted_path)
+      else:
+        continue
+      if files:
+        tables[table_name] = [files, reader]
+    return tables
+
+  def get_data_version(self) -> str:
+    '''
+      Returns a token that changes whenever a table file is added, removed or rewritten
+    '''
+    file_stats = []
+    for [files, _] in self.get_table_files().values():
+      for f in files:
+        stat = os.stat(f)
+        file_stats.append('{}:{}:{}'.format(f, stat.st_size, stat.st_mtime_ns))
+    return '|'.join(file_stats)
+
+  def connect(self):
+    '''
+      Returns a DuckDB connection with a view of every table file and the user_month_activity rollup,
+      which are recreated if the files have changed since they were last read
+    '''
+    # DuckDB is only needed by (and only imported for) this engine
+    import duckdb
+    data_version = self.get_data_version()
+    with self.lock:
+      if self.connection is None or data_version != self.data_version:
+        tables = self.get_table_files()
+        if 'action_events' not in tables:
+          raise FileNotFoundError('No action_events table found in {}'.format(self.directory))
+        if self.connection is not None:
+          self.connection.close()
+        connection = duckdb.connect()
+        # Timestamps are loaded as UTC, so months are bucketed in UTC like Postgres sessions in UTC do
+        connection.execute("SET TimeZone = 'UTC'")
+        for table_name, [_, reader] in tables.items():
+          connection.execute('CREATE VIEW {} AS SELECT * FROM {}'.format(table_name, reader))
+        if 'users' not in tables:
+          connection.execute('CREATE VIEW users AS SELECT user_id, CAST(NULL AS VARCHAR) AS country FROM action_events WHERE FALSE')
+        connection.execute('CREATE TABLE user_month_activity AS {}'.format(USER_MONTH_ACTIVITY_SQL))
+        self.connection = connection
+        self.data_version = data_version
+      # Each cursor is a separate connection to the same database, so queries can run on several threads
+      return self.connection.cursor()
+
+  def query(self, sql: sqlalchemy.sql.text) -> pd.DataFrame:
+    '''
+      Runs a query written for Postgres in SQL that DuckDB also understands, returning its results as a DataFrame
+    '''
+    compiled = sql.compile(dialect=sqlalchemy.engine.default.DefaultDialect(paramstyle='qmark'))
+    parameters = [compiled.params[name] for name in compiled.positiontup]
+    connection = self.connect()
+    try:
+      return connection.execute(compiled.string, parameters).df()
+    finally:
+      connection.close()
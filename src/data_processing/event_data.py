@@ -0,0 +1,62 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+'''
+  Decodes the JSON `data` column of raw analytics exports into one column per key.
+'''
+
+# Keys of the `data` object that are decoded directly into columns
+# Any other key (or a nested object) is flattened with `pd.json_normalize`, like before
+EVENT_DATA_KEYS = ['action', 'screen', 'version']
+# Columns with fewer rows than this are not worth sending to other processes
+MIN_PARALLEL_ROWS = 100000
+
+def decode_data_column(data: pd.Series) -> pd.DataFrame:
+  '''
+    Decodes a column of JSON objects into a DataFrame with one column per key and the same index as `data`.
+    The whole column is parsed by a single `json.loads` call and each known key is gathered into a column in one pass.
+    Columns are ordered by the first row that has the key, matching normalizing each row and concatenating the results.
+  '''
+  records = json.loads('[' + ','.join(data.fillna('{}')) + ']')
+  known_keys = set(EVENT_DATA_KEYS)
+  is_simple_record = np.fromiter((all(k in known_keys and not isinstance(v, dict) for k, v in r.items()) for r in records),
+                                 dtype=bool, count=len(records))
+
+  columns = {}
+  for key in EVENT_DATA_KEYS:
+    if any(key in r for r in records):
+      columns[key] = pd.Series([r.get(key, np.nan) if simple else np.nan for r, simple in zip(records, is_simple_record)], index=data.index)
+  decoded = pd.DataFrame(columns, index=data.index)
+
+  if not is_simple_record.all():
+    fallback_index = data.index[~is_simple_record]
+    normalized = pd.json_normalize([r for r, simple in zip(records, is_simple_record) if not simple])
+    normalized.index = fallback_index
+    for c in normalized.columns:
+      if c not in decoded.columns:
+        decoded[c] = np.nan
+      decoded.loc[fallback_index, c] = normalized[c]
+
+  return order_columns_by_first_row(decoded)
+
+def order_columns_by_first_row(decoded: pd.DataFrame) -> pd.DataFrame:
+  '''
+    Orders columns by the first row that has a value for them
+  '''
+  is_present = decoded.notna().to_numpy()
+  first_rows = np.where(is_present.any(axis=0), is_present.argmax(axis=0), len(decoded))
+  return decoded.iloc[:, np.argsort(first_rows, kind='stable')]
+
+def decode_data_column_in_parallel(data: pd.Series, executor=None, workers: int = 1) -> pd.DataFrame:
+  '''
+    Decodes a column of JSON objects like `decode_data_column`, splitting the rows across `executor`, a pool of `workers`
+    processes, or in this process if there is none. The pool is created by the caller so that it can be shared by
+    every chunk that is decoded, as starting the processes can take longer than decoding a chunk.
+  '''
+  if executor is None or workers <= 1 or len(data) < MIN_PARALLEL_ROWS:
+    return decode_data_column(data)
+  slices = np.array_split(np.arange(len(data)), workers)
+  decoded = list(executor.map(decode_data_column, [data.iloc[s] for s in slices]))
+  return order_columns_by_first_row(pd.concat(decoded, sort=False))
@@ -0,0 +1,49 @@
+import argparse
+import os
+import shutil
+
+import pandas as pd
+
+from db_manager import EMBEDDED_ENGINE_PREFIX, EMBEDDED_TABLES, get_sql_engine, write_parquet_table
+from load_data import EVENT_TABLES
+
+'''
+  This script exports the normalized tables loaded by load_data.py to Parquet files, which the dashboard can then
+  query without a database server: `python src/data_processing/export_tables.py data/local`, then set
+  `DB_CONNECTION_STRING=duckdb:///data/local`.
+'''
+
+# Number of rows read from the database and written to Parquet at a time
+EXPORT_CHUNK_SIZE = 100000
+
+def export_tables(directory: str, engine = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+  '''
+    Writes each table in EMBEDDED_TABLES that exists in the database to a `<directory>/<table>` Parquet dataset,
+    replacing any earlier export. Rows are streamed from a server-side cursor and written `chunk_size` at a time,
+    so large tables are never held in memory. Event tables are partitioned by month, see db_manager.write_parquet_table.
+  '''
+  if engine is None:
+    engine = get_sql_engine()
+  os.makedirs(directory, exist_ok=True)
+  for table_name in EMBEDDED_TABLES:
+    with engine.connect() as connection:
+      if not engine.dialect.has_table(connection, table_name):
+        continue
+    shutil.rmtree(os.path.join(directory, table_name), ignore_errors=True)
+    if os.path.exists(os.path.join(directory, '{}.parquet'.format(table_name))):
+      os.remove(os.path.join(directory, '{}.parquet'.format(table_name)))
+    row_count = 0
+    with engine.connect().execution_options(stream_results=True) as connection:
+      for i, df in enumerate(pd.read_sql_table(table_name, connection, chunksize=chunk_size)):
+        write_parquet_table(df, table_name, directory, 'export-{}'.format(i),
+                            partition_column='time' if table_name in EVENT_TABLES else None)
+        row_count += len(df)
+    print('Exported {:,} rows from {}'.format(row_count, table_name))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Export the normalized tables to Parquet files for the embedded engine.')
+  parser.add_argument('directory', help='Directory to write the Parquet files to')
+  parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Number of rows exported at a time')
+  args = parser.parse_args()
+  export_tables(args.directory, chunk_size=args.chunk_size)
+  print('Set DB_CONNECTION_STRING={}{} to build the dashboard from these files'.format(EMBEDDED_ENGINE_PREFIX, args.directory))
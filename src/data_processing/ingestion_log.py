@@ -0,0 +1,66 @@
+import hashlib
+import os
+
+'''
+  Keeps track of the raw export files that have been loaded into the database, so that incremental loads
+  can skip files they have already seen, and so that what changed in each load can be told from the time range of its events.
+'''
+
+INGESTION_LOG_TABLE = 'ingested_files'
+
+def fingerprint_file(path: str) -> [int, str]:
+  '''
+    Returns the size and SHA-256 hash of a file, reading it in blocks so large exports are not held in memory
+  '''
+  content_hash = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      content_hash.update(block)
+  return [os.path.getsize(path), content_hash.hexdigest()]
+
+def ensure_ingestion_log(connection):
+  '''
+    Creates the ingestion log table if it does not exist yet
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS public.{} (
+                      content_hash TEXT PRIMARY KEY,
+                      file_name TEXT NOT NULL,
+                      file_size BIGINT NOT NULL,
+                      row_count BIGINT NOT NULL,
+                      max_event_time TIMESTAMP WITH TIME ZONE,
+                      loaded_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+                    )
+                    '''.format(INGESTION_LOG_TABLE))
+    # Logs created before earliest event times were recorded
+    cursor.execute('ALTER TABLE public.{} ADD COLUMN IF NOT EXISTS min_event_time TIMESTAMP WITH TIME ZONE'.format(INGESTION_LOG_TABLE))
+
+def clear_ingestion_log(connection):
+  '''
+    Forgets every logged file, e.g. when all tables are about to be reloaded from scratch
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute('DELETE FROM public.{}'.format(INGESTION_LOG_TABLE))
+
+def is_file_ingested(connection, content_hash: str) -> bool:
+  '''
+    Checks whether a file with the same content has already been loaded
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute('SELECT 1 FROM public.{} WHERE content_hash = %s'.format(INGESTION_LOG_TABLE), (content_hash,))
+    return cursor.fetchone() is not None
+
+def record_ingested_file(connection, file_name: str, file_size: int, content_hash: str, row_count: int, max_event_time = None,
+                         min_event_time = None):
+  '''
+    Logs a loaded file along with the earliest and latest event times it contained
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute('''
+                    INSERT INTO public.{} (content_hash, file_name, file_size, row_count, min_event_time, max_event_time)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (content_hash) DO UPDATE
+                    SET file_name = EXCLUDED.file_name, row_count = EXCLUDED.row_count,
+                        min_event_time = EXCLUDED.min_event_time, max_event_time = EXCLUDED.max_event_time, loaded_at = now()
+                    '''.format(INGESTION_LOG_TABLE), (content_hash, file_name, file_size, row_count, min_event_time, max_event_time))
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+
+import pandas as pd
+
+import db_manager
+import query_cache
+
+'''
+  Keeps a single copy of the dashboard aggregates that is refreshed in the background and shared by every viewer
+  of the live dashboard, so that the number of open sessions does not add load to the database.
+'''
+
+REFRESH_INTERVAL = float(os.getenv('LIVE_REFRESH_INTERVAL', 30))  # In seconds
+# How long a new session waits for the first aggregates before showing empty plots, in seconds
+FIRST_REFRESH_TIMEOUT = float(os.getenv('LIVE_FIRST_REFRESH_TIMEOUT', 5))
+
+latest = {
+  'revision': 0,          # Incremented whenever the aggregates change
+  'aggregates': None,     # As returned by db_manager.get_dashboard_aggregates
+  'data_version': None,   # The db_manager.get_data_version the aggregates were fetched at
+  'loaded_at': None,      # When the last file in the ingestion log was loaded
+  'file_count': 0,        # The number of files in the ingestion log
+}
+latest_lock = threading.Lock()
+first_refresh = threading.Event()
+refresh_thread = None
+
+def merge_aggregates(aggregates: list, recent_aggregates: list, start_date) -> list:
+  '''
+    Replaces the rows of each aggregate from the month of `start_date` onwards with more recently fetched rows
+  '''
+  month_start = pd.Timestamp(db_manager.get_period_start(start_date, 'month'))
+  merged = []
+  for df, recent in zip(aggregates, recent_aggregates):
+    is_earlier = df['date'] < month_start
+    merged.append(db_manager.to_compact_dtypes(pd.concat([df[is_earlier], recent], ignore_index=True)))
+  return merged
+
+def refresh(engine) -> bool:
+  '''
+    Fetches the aggregates that changed since the last refresh, returning whether anything changed.
+    Changes are detected with db_manager.get_data_version, which covers both Postgres and the embedded engine.
+    Loading analytics exports only adds events from the earliest event time of the new files on, so only the months
+    from there on are fetched again. Any other change (e.g. a users export, which can change the country of any user,
+    or table files of the embedded engine, which have no ingestion log) fetches everything.
+  '''
+  data_version = db_manager.get_data_version(engine)
+  if latest['aggregates'] is not None and data_version == latest['data_version']:
+    return False
+  ingestion_log = db_manager.get_ingestion_log(engine)
+  if latest['loaded_at'] is None:
+    new_files = ingestion_log
+  else:
+    new_files = ingestion_log[ingestion_log['loaded_at'] > latest['loaded_at']]
+
+  # A full reload clears the log, so it no longer holds the previously logged files
+  new_event_times = new_files['min_event_time'].dropna()
+  only_events_added = (latest['aggregates'] is not None and not new_event_times.empty
+                       and len(ingestion_log) == latest['file_count'] + len(new_files)
+                       and new_files['file_name'].str.startswith('analytics').all())
+  if only_events_added:
+    start_date = new_event_times.min().date()
+    aggregates = merge_aggregates(latest['aggregates'], db_manager.get_dashboard_aggregates(engine, start_date), start_date)
+  else:
+    aggregates = query_cache.cached_query(db_manager.get_dashboard_aggregates, engine)
+
+  with latest_lock:
+    latest['aggregates'] = aggregates
+    latest['data_version'] = data_version
+    latest['revision'] += 1
+    latest['file_count'] = len(ingestion_log)
+    if not new_files.empty:
+      latest['loaded_at'] = new_files['loaded_at'].max()
+  return True
+
+def refresh_periodically(engine, interval: float):
+  '''
+    Refreshes the aggregates every `interval` seconds. Failed refreshes are tried again at the next interval,
+    and sessions waiting for the first aggregates keep waiting until a refresh succeeds.
+  '''
+  while True:
+    try:
+      refresh(engine)
+      first_refresh.set()
+    except Exception as e:
+      # Keep serving the last aggregates if the database is briefly unavailable
+      print('Failed to refresh dashboard aggregates: {}'.format(e))
+    time.sleep(interval)
+
+def start_background_refresh(engine = None, interval: float = REFRESH_INTERVAL):
+  '''
+    Starts the thread refreshing the shared aggregates every `interval` seconds, unless it is already running
+  '''
+  global refresh_thread
+  with latest_lock:
+    if refresh_thread is not None:
+      return
+    if engine is None:
+      engine = db_manager.get_sql_engine()
+    refresh_thread = threading.Thread(target=refresh_periodically, args=(engine, interval), daemon=True)
+    refresh_thread.start()
+
+def get_empty_aggregates() -> list:
+  '''
+    Returns aggregates with the columns of db_manager.get_dashboard_aggregates but no rows,
+    for sessions to show until the first refresh succeeds
+  '''
+  totals = pd.DataFrame({'year': [], 'month': [], 'date': pd.Series([], dtype='datetime64[ns]'), 'count': []})
+  totals_by_country = totals.assign(country=pd.Series([], dtype=object))[['year', 'month', 'date', 'country', 'count']]
+  return [db_manager.to_compact_dtypes(df.copy()) for df in [totals, totals, totals, totals_by_country, totals_by_country]]
+
+def get_latest_aggregates(timeout: float = None) -> [int, list]:
+  '''
+    Returns the revision number and the latest aggregates, waiting up to `timeout` seconds (or as long as it takes)
+    for the first successful refresh if needed. The aggregates are None if there has not been one by then.
+  '''
+  first_refresh.wait(timeout)
+  with latest_lock:
+    return [latest['revision'], latest['aggregates']]
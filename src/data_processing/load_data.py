@@ -1,31 +1,123 @@
+import argparse
 import glob
-import json
 import os
+import shutil
+import tempfile
+import time
+from collections import deque
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from itertools import islice
+from typing import List
 
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from inflection import underscore
 
-from db_manager import get_sql_engine
+from db_manager import (add_missing_columns, copy_dataframe, create_index, create_month_partitions, create_table,
+                        create_unique_index, get_sql_engine, get_table_columns,
+                        merge_dataframe, update_user_month_activity, write_parquet_table)
+from event_data import decode_data_column_in_parallel
+from ingestion_log import (clear_ingestion_log, ensure_ingestion_log, fingerprint_file, is_file_ingested,
+                           record_ingested_file)
+from user_sketches import SKETCH_ERROR, update_user_sketches
 
 '''
   This script loads and normalizes raw analytics logs.
   Raw analytics logs should be placed in the `data` directory in the root of this repository.
 '''
 
+TEXT_DATE_LENGTH = len('Sun Sep 27 2020 02:34:57 GMT+0000')
+TEXT_DATE_SEPARATORS = {3: ' ', 7: ' ', 10: ' ', 15: ' ', 18: ':', 21: ':', 24: ' ', 25: 'G', 26: 'M', 27: 'T'}
+TEXT_DATE_PATTERN = r'^\w{3} (\w{3} \d{1,2} \d{4} \d{2}:\d{2}:\d{2}) GMT([+-]\d{4})'
+TEXT_DATE_FORMAT = '%b %d %Y %H:%M:%S%z'
+MONTH_ABBREVIATIONS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+# pandas >= 2 infers a single layout from the first row unless told to accept any ISO 8601 layout
+ISO_DATE_FORMAT = 'ISO8601' if int(pd.__version__.split('.')[0]) >= 2 else None
+
+def parse_text_dates(values: pd.Series) -> pd.Series:
+  '''
+    Parses dates such as 'Sun Sep 27 2020 02:34:57 GMT+0000 (Coordinated Universal Time)' into UTC datetimes.
+    Every field has a fixed character position, so the whole column is parsed with array arithmetic.
+    Rows that do not have the expected layout or whose fields are out of range (e.g. 'Feb 29 2021') fall back to
+    a (slower) regular expression and strptime, which raise a ValueError for values that are not valid dates.
+  '''
+  chars = values.to_numpy().astype('U{}'.format(TEXT_DATE_LENGTH)).view(np.uint32).reshape(-1, TEXT_DATE_LENGTH).astype(np.int64)
+  digits = chars - ord('0')
+
+  def number(start: int, end: int) -> np.ndarray:
+    n = np.zeros(len(chars), dtype=np.int64)
+    for i in range(start, end):
+      n = n * 10 + digits[:, i]
+    return n
+
+  def key(string) -> np.ndarray:
+    return string[..., 0] * 65536 + string[..., 1] * 256 + string[..., 2]
+
+  month_keys = key(np.array([[ord(c) for c in m] for m in MONTH_ABBREVIATIONS]))
+  month_order = np.argsort(month_keys)
+  row_month_keys = key(chars[:, 4:7])
+  months = month_order[np.minimum(np.searchsorted(month_keys[month_order], row_month_keys), len(month_keys) - 1)]
+
+  digit_columns = [8, 9, 11, 12, 13, 14, 16, 17, 19, 20, 22, 23, 29, 30, 31, 32]
+  is_valid = ((month_keys[months] == row_month_keys)
+              & ((digits[:, digit_columns] >= 0) & (digits[:, digit_columns] <= 9)).all(axis=1)
+              & np.isin(chars[:, 28], [ord('+'), ord('-')]))
+  for position, separator in TEXT_DATE_SEPARATORS.items():
+    is_valid &= chars[:, position] == ord(separator)
+
+  month_starts = (number(11, 15) - 1970).astype('M8[Y]').astype('M8[M]') + months.astype('m8[M]')
+  days = number(8, 10)
+  local_dates = month_starts.astype('M8[D]') + (days - 1).astype('m8[D]')
+  # Days past the end of their month would otherwise roll over into the next month
+  is_valid &= ((days >= 1) & (local_dates.astype('M8[M]') == month_starts)
+               & (number(16, 18) <= 23) & (number(19, 21) <= 59) & (number(22, 24) <= 59) & (number(31, 33) <= 59))
+  seconds = number(16, 18) * 3600 + number(19, 21) * 60 + number(22, 24)
+  offset_minutes = np.where(chars[:, 28] == ord('-'), -1, 1) * (number(29, 31) * 60 + number(31, 33))
+  dates = local_dates.astype('M8[s]') + seconds.astype('m8[s]') - offset_minutes.astype('m8[m]')
+  dates[~is_valid] = np.datetime64('NaT')
+  converted = pd.Series(pd.to_datetime(dates, utc=True), index=values.index)
+
+  if not is_valid.all():
+    parts = values[~is_valid].str.extract(TEXT_DATE_PATTERN)
+    is_unknown = parts[0].isna()
+    if is_unknown.any():
+      raise ValueError('Unknown date format: {!r}'.format(values[~is_valid][is_unknown].iloc[0]))
+    fallback_dates = [datetime.strptime(text, TEXT_DATE_FORMAT) for text in parts[0] + parts[1]]
+    converted[~is_valid] = pd.Series(pd.to_datetime(fallback_dates, utc=True), index=parts.index)
+  return converted
+
 def convert_to_datetime(df: pd.DataFrame, column: str) -> pd.DataFrame:
   '''
-    Converts a column in the provided DataFrame from a string to a datetime object
-    Can handle date strings in either of two formats:
+    Converts a column in the provided DataFrame from a string to a timezone-aware (UTC) datetime
+    Each row can be in either of two formats, and the formats may be mixed within a column:
       e.g. 'Sun Sep 27 2020 02:34:57 GMT+0000 (Coordinated Universal Time)' 
             or
             '2020-09-26 23:30:04.947+00'
+    The format of every row is classified up front and each group of rows is parsed in bulk.
+    Missing values become NaT, while values that are not valid dates in either format raise a ValueError.
   '''
-  if df.iloc[0][column][0].isalpha():
-    df[column] = df[column].map(lambda datestr: datetime.strptime(datestr.split(' GMT+0000 ', 1)[0], '%a %b %d %Y %H:%M:%S'))
-  else:
-    df[column] = df[column].map(lambda datestr: datetime.strptime(datestr.split('.', 1)[0].split('+', 1)[0], '%Y-%m-%d %H:%M:%S'))
+  values = df[column]
+  converted = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns, UTC]')
+  is_present = values.notna()
+  is_text_date = is_present & values.str[:1].str.isalpha().fillna(False).astype(bool)
+  is_iso_date = is_present & ~is_text_date
+
+  if is_text_date.any():
+    converted[is_text_date] = parse_text_dates(values[is_text_date])
+  if is_iso_date.any():
+    converted[is_iso_date] = pd.to_datetime(values[is_iso_date], format=ISO_DATE_FORMAT, utc=True)
+  df[column] = converted
+
+# Device details are stored in `devices.<n>.<field>` columns of users exports
+DEVICE_COLUMN_PATTERN = r'^devices\.(\d+)\.(.+)$'
+# Device fields that are not loaded
+EXCLUDED_DEVICE_FIELDS = ['osVersion']
+# Device fields with few distinct values, which are stored as categories
+CATEGORICAL_DEVICE_FIELDS = ['platform', 'version']
 
 def load_users_and_devices(users: pd.DataFrame) -> [pd.DataFrame, pd.DataFrame]:
   '''
@@ -40,73 +132,363 @@ def load_users_and_devices(users: pd.DataFrame) -> [pd.DataFrame, pd.DataFrame]:
   convert_to_datetime(user_info, 'created_at')
 
   # Users may have multiple devices
-  # Device details are concatenated in a wide format
-  # Split the device records into a normalized dataframe
-  device_info = users.filter(regex='userId|devices.*(?<!osVersion)$')
-  device_info.columns = device_info.columns.str.replace('devices\.\d\.', '')
-  DEVICE_DATA_COLUMN_COUNT = 4  # Each device record has 4 data columns
-  data_column_count = (len(device_info.columns) - 1)
-  max_devices = data_column_count // DEVICE_DATA_COLUMN_COUNT
-  all_device_info = None
-  for i in range(max_devices):
-    curr_data_columns = list(range(1 + (i * DEVICE_DATA_COLUMN_COUNT), ((i + 1) * DEVICE_DATA_COLUMN_COUNT) + 1))
-    curr_device_info = device_info.iloc[:, [0] + curr_data_columns]
-    curr_device_info = curr_device_info.dropna()
-    if all_device_info is not None:
-      all_device_info = all_device_info.append(curr_device_info)
-    else:
-      all_device_info = curr_device_info
-  all_device_info.columns = all_device_info.columns.str.replace('^_id', 'device_id')
-  all_device_info.rename(columns=lambda c: underscore(c), inplace=True)
-  convert_to_datetime(all_device_info, 'last_seen')
+  # Device details are concatenated in a wide format, with `devices.<n>.<field>` columns for the nth device of each user
+  # Reshape them into a normalized dataframe with one row per device
+  device_info = get_device_info(users)
+  device_info.rename(columns=lambda c: underscore(c), inplace=True)
+  convert_to_datetime(device_info, 'last_seen')
+
+  return [user_info, device_info]
 
-  return [user_info, all_device_info]
+def get_device_info(users: pd.DataFrame) -> pd.DataFrame:
+  '''
+    Reshapes the wide `devices.<n>.<field>` columns of a users export into one row per device, in a single pass
+    driven by the column names, so any number of devices and device fields is supported.
+    The columns of each field are stacked device by device, so rows are ordered by device number, then by user.
+    Devices missing any of their fields are dropped.
+  '''
+  device_columns = users.columns.to_series().str.extract(DEVICE_COLUMN_PATTERN).dropna()
+  device_columns = device_columns[~device_columns[1].isin(EXCLUDED_DEVICE_FIELDS)]
+  device_numbers = sorted(device_columns[0].astype(int).unique())
+  column_names = {(field, int(n)): c for c, (n, field) in device_columns.iterrows()}
+
+  user_ids = np.tile(users['userId'].to_numpy(), len(device_numbers))
+  is_complete = pd.notna(user_ids)
+  columns = {'userId': user_ids}
+  for field in dict.fromkeys(device_columns[1]):
+    # Devices that have no column for this field are treated as missing it
+    columns[field] = np.concatenate([users[column_names[field, n]].to_numpy() if (field, n) in column_names
+                                     else np.full(len(users), np.nan) for n in device_numbers])
+    is_complete &= pd.notna(columns[field])
+
+  device_info = pd.DataFrame({c: values[is_complete] for c, values in columns.items()}).rename(columns={'_id': 'device_id'})
+  for c in CATEGORICAL_DEVICE_FIELDS:
+    if c in device_info.columns:
+      device_info[c] = device_info[c].astype('category')
+  return device_info
 
-def load_events(analytics: pd.DataFrame) -> [pd.DataFrame, pd.DataFrame]:
+def load_events(analytics: pd.DataFrame, json_executor: ProcessPoolExecutor = None, json_workers: int = 1) -> [pd.DataFrame, pd.DataFrame]:
   '''
     Converts a raw analytics data dump into two DataFrames:
       1. A page_events DataFrame, detailing the pages viewed by individual users
       2. A action_events DataFrame, detailing specific actions that individual users completed
+    Large JSON data columns are decoded across `json_executor`, a pool of `json_workers` processes, if given.
   '''
   analytics.rename(columns={'version':'app_version'}, inplace=True)
   analytics.drop(columns=['arch', 'avail_ram', 'country', 'duration', 'first_time', 'locale', 'module_version', 'os_version', 'platform', 'error_hash'], inplace=True)
   analytics.dropna(subset=['user_id'], inplace=True)
   convert_to_datetime(analytics, 'time')
-  # Normalize the JSON column into column and concatenate the column on the dataframe
-  analytics = (pd.concat({i: pd.json_normalize(json.loads(datum)) for i, datum in analytics.pop('data').items()})
-          .reset_index(level=1, drop=True)
+  # Normalize the JSON column into columns and concatenate the columns on the dataframe
+  analytics = (decode_data_column_in_parallel(analytics.pop('data'), json_executor, json_workers)
           .join(analytics)
           .reset_index(drop=True))
 
   is_screen_view_row = analytics.type.str.startswith('SCREEN_VIEW')
   page_events = analytics.loc[is_screen_view_row]
-  page_events = page_events.drop(columns=['version', 'action', 'type', 'app_version'])
+  page_events = page_events.drop(columns=['version', 'action', 'type', 'app_version'], errors='ignore')
   action_events = analytics.loc[~is_screen_view_row]
-  action_events = action_events.drop(columns=['version', 'screen'])
+  action_events = action_events.drop(columns=['version', 'screen'], errors='ignore')
 
   return [action_events, page_events]
 
-def load_data_directory():
+# Columns identifying a row of each table, which incremental loads deduplicate on
+TABLE_KEYS = {
+  'users': ['user_id'],
+  'devices': ['user_id', 'device_id'],
+  'action_events': ['user_id', 'session_id', 'time', 'type'],
+  'page_events': ['user_id', 'session_id', 'time', 'screen'],
+}
+EVENT_TABLES = ['action_events', 'page_events']
+# Indexes supporting the date range filters of the dashboard queries, which compare the time of events against constants
+EVENT_INDEXES = {
+  'action_events': [['time'], ['user_id', 'time']],
+}
+
+def read_export(f: str, chunk_size: int = None):
+  '''
+    Reads a raw CSV export, yielding it in chunks of `chunk_size` rows or whole if no chunk size is given
+  '''
+  if chunk_size is None:
+    yield pd.read_csv(f)
+  else:
+    yield from pd.read_csv(f, chunksize=chunk_size)
+
+def normalize_chunks(f: str, loader, chunk_size: int = None):
+  '''
+    Streams a raw CSV export through `loader`, in chunks of `chunk_size` rows if given so that peak memory
+    does not depend on the size of the file.
+    Yields the number of raw rows in each chunk along with the normalized DataFrames `loader` returns for it.
+  '''
+  for chunk in read_export(f, chunk_size):
+    yield [len(chunk), loader(chunk)]
+
+def normalize_file(f: str, loader, chunk_size: int, directory: str) -> [List[str], float]:
+  '''
+    Normalizes a raw export in a worker process, saving each normalized chunk to a pickle file in `directory`
+    so that the writer process can load the chunks one at a time.
+    Returns the paths of the pickle files, in order, and the time taken.
+  '''
+  start_time = time.perf_counter()
+  paths = []
+  for i, normalized_chunk in enumerate(normalize_chunks(f, loader, chunk_size)):
+    path = os.path.join(directory, '{}-{}.pickle'.format(os.path.basename(f), i))
+    pd.to_pickle(normalized_chunk, path)
+    paths.append(path)
+  return [paths, time.perf_counter() - start_time]
+
+def read_normalized_chunks(paths: List[str]):
+  '''
+    Yields the normalized chunks saved by `normalize_file`, deleting each file once it has been read
+  '''
+  for path in paths:
+    normalized_chunk = pd.read_pickle(path)
+    os.remove(path)
+    yield normalized_chunk
+
+def normalize_files_in_pool(executor, files: list, window: int, chunk_size: int, directory: str):
+  '''
+    Normalizes `files` ([path, loader] pairs) with `normalize_file` in a process pool, yielding the chunks of each file
+    (see `read_normalized_chunks`) and the time taken to normalize it, in order.
+    Only `window` files are handed to the workers ahead of the one being read, so that when writing the chunks
+    is slower than normalizing them, the chunks waiting on disk do not grow to the size of the whole export.
+  '''
+  files = iter(files)
+  pending = deque(executor.submit(normalize_file, f, loader, chunk_size, directory) for [f, loader] in islice(files, window))
+  while pending:
+    [paths, normalize_time] = pending.popleft().result()
+    for [f, loader] in islice(files, 1):
+      pending.append(executor.submit(normalize_file, f, loader, chunk_size, directory))
+    yield [read_normalized_chunks(paths), normalize_time]
+
+def load_file(normalized_chunks, table_names: List[str], connection, table_columns: dict,
+              incremental: bool = False, partition_events: bool = False,
+              remove_duplicates: bool = False) -> [int, pd.Timestamp, pd.Timestamp]:
+  '''
+    Bulk copies each chunk from `normalized_chunks` (see `normalize_chunks`) into the matching tables from `table_names`
+    over `connection`, which tables are also created over, so that a file is loaded (or rolled back) as a whole.
+    `table_columns` holds the column types of every table written so far in this load (see get_table_columns),
+    and is updated as tables are written.
+    By default a table is replaced the first time it is written in a load, so that every file adds to it after that.
+    If `incremental` is set, rows already in the tables are not inserted again and existing users and devices
+    are updated in place, so files overlapping ones loaded before (or loaded again) add only the rows that are new.
+    If `partition_events` is set, event tables created by this load are partitioned by month, see create_table.
+    `remove_duplicates` allows incremental loads to remove duplicate rows from existing tables, see create_unique_index.
+    Returns the number of raw rows read and the earliest and latest event times in the file.
+  '''
+  row_count = 0
+  min_event_time = None
+  max_event_time = None
+  for [chunk_row_count, tables] in normalized_chunks:
+    row_count += chunk_row_count
+    for table_name, df in zip(table_names, tables):
+      if table_name in EVENT_TABLES and not df.empty:
+        chunk_min_event_time = df['time'].min()
+        chunk_max_event_time = df['time'].max()
+        min_event_time = chunk_min_event_time if min_event_time is None else min(min_event_time, chunk_min_event_time)
+        max_event_time = chunk_max_event_time if max_event_time is None else max(max_event_time, chunk_max_event_time)
+
+      if table_name not in table_columns:
+        create_table(df, table_name, connection, partition_column='time' if partition_events and table_name in EVENT_TABLES else None,
+                     replace=not incremental)
+        if incremental:
+          create_unique_index(table_name, TABLE_KEYS[table_name], connection, remove_duplicates)
+        table_columns[table_name] = get_table_columns(table_name, connection)
+      # Chunks may not contain every key of the JSON data column
+      add_missing_columns(df, table_name, table_columns[table_name], connection)
+      if table_name in EVENT_TABLES:
+        create_month_partitions(df['time'], table_name, connection)
+
+      if incremental:
+        merge_dataframe(df, table_name, TABLE_KEYS[table_name], connection, update=table_name not in EVENT_TABLES)
+      else:
+        copy_dataframe(df, table_name, connection)
+  return [row_count, min_event_time, max_event_time]
+
+def write_file_to_parquet(f: str, loader, table_names: List[str], directory: str, chunk_size: int = None) -> int:
+  '''
+    Streams a raw CSV export through `loader` like `load_file`, writing each normalized chunk to the Parquet dataset
+    of the matching table in `directory` instead of the database. Event tables are partitioned by month.
+    Returns the number of raw rows read.
+  '''
+  basename = os.path.splitext(os.path.basename(f))[0]
+  row_count = 0
+  for i, [chunk_row_count, tables] in enumerate(normalize_chunks(f, loader, chunk_size)):
+    row_count += chunk_row_count
+    for table_name, df in zip(table_names, tables):
+      write_parquet_table(df, table_name, directory, '{}-{}'.format(basename, i),
+                          partition_column='time' if table_name in EVENT_TABLES else None)
+  return row_count
+
+def get_file_loader(file_name: str, json_executor: ProcessPoolExecutor = None, json_workers: int = 1):
+  '''
+    Returns the loader for a raw export and the tables it loads into, or None if the file is not an export.
+    Analytics exports decode their JSON data column across `json_executor`, see `load_events`.
+  '''
+  if file_name.startswith('users'):
+    return [load_users_and_devices, ['users', 'devices']]
+  if file_name.startswith('analytics'):
+    return [partial(load_events, json_executor=json_executor, json_workers=json_workers), ['action_events', 'page_events']]
+  return None
+
+def write_data_directory_to_parquet(raw_files: List[str], directory: str, chunk_size: int = None, json_workers: int = 1,
+                                    incremental: bool = False, workers: int = 1):
+  '''
+    Writes the normalized tables of every raw export to Parquet datasets in `directory`, one per table.
+    The datasets are replaced unless `incremental` is set, in which case files are added to them.
+    Loading the same export again overwrites the files written from it the first time.
+    Files are written by a pool of `workers` processes if there is more than one, as they do not depend on each other.
+  '''
+  if not incremental:
+    for table_name in TABLE_KEYS:
+      shutil.rmtree(os.path.join(directory, table_name), ignore_errors=True)
+  write_file = partial(write_timed, write_file_to_parquet, directory=directory, chunk_size=chunk_size)
+  with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor, \
+       ProcessPoolExecutor(max_workers=json_workers) if workers == 1 and json_workers > 1 else nullcontext() as json_executor:
+    files = [[f] + get_file_loader(os.path.basename(f), json_executor, json_workers)
+             for f in raw_files if get_file_loader(os.path.basename(f)) is not None]
+    if executor is None:
+      results = (write_file(f, loader, table_names) for [f, loader, table_names] in files)
+    else:
+      results = executor.map(write_file, *zip(*files))
+    for i, [[f, _, _], [row_count, elapsed]] in enumerate(zip(files, results)):
+      print('[{}/{}] Wrote {} rows from {} in {:.1f}s ({:,.0f} rows/sec)'.format(
+        i + 1, len(files), row_count, os.path.basename(f), elapsed, row_count / max(elapsed, 1e-9)))
+
+def write_timed(write_file, *args, **kwargs) -> [int, float]:
+  '''
+    Calls `write_file`, returning its result along with the time it took
+  '''
+  start_time = time.perf_counter()
+  result = write_file(*args, **kwargs)
+  return [result, time.perf_counter() - start_time]
+
+def load_data_directory(chunk_size: int = None, json_workers: int = 1, incremental: bool = False, parquet_directory: str = None,
+                        workers: int = 1, sketch_error: float = None, partition_events: bool = False,
+                        remove_duplicates: bool = False):
   '''
     Loads analytics and user data dump CSV files from the data directory in this repository
     and parses them and inserts them into the database.
     Although there is only one analytics and users data file each, their names are suffixed
-    with unique identifiers each time the data is exported.
+    with unique identifiers each time the data is exported, and large exports may be split into several files.
+    Files are loaded in order of their names. If `chunk_size` is given, each file is streamed in chunks of that many rows.
+    Rows are bulk copied into the database over a single pooled connection.
+    `json_workers` is the number of processes used to decode the JSON data column of large analytics exports.
+    If `workers` is more than one, files are parsed and normalized by a pool of that many processes instead,
+    while this process writes their results to the database one file at a time, in order.
+    If `incremental` is set, the tables are kept and only files and events that have not been loaded yet are added.
+    Tables that already hold duplicate rows (e.g. from a full load of overlapping exports) cannot be loaded incrementally
+    unless `remove_duplicates` is set, which keeps only the last copy of each row.
+    If `parquet_directory` is given, the tables are written to Parquet datasets there instead of the database.
+    If `sketch_error` is given, sketches of the users active each day are kept up to date with this relative error,
+    see user_sketches.py.
+    The event tables are indexed for the date range filters of the dashboard, and partitioned by month if
+    `partition_events` is set.
   '''
   script_directory = os.path.dirname(__file__)
-  raw_files = glob.glob(os.path.join(script_directory, '../../data/*.csv'))
+  raw_files = sorted(glob.glob(os.path.join(script_directory, '../../data/*.csv')))
+  if parquet_directory is not None:
+    write_data_directory_to_parquet(raw_files, parquet_directory, chunk_size, json_workers, incremental, workers)
+    return
   db_engine = get_sql_engine()
-  for f in raw_files:
-    file_name = os.path.basename(f)
-    if file_name.startswith('users'):
-      users = pd.read_csv(f)
-      [users, devices] = load_users_and_devices(users)
-      users.to_sql('users', db_engine, schema='public', if_exists='replace', index=False)
-      devices.to_sql('devices', db_engine, schema='public', if_exists='replace', index=False)
-    elif file_name.startswith('analytics'):
-      analytics = pd.read_csv(f)
-      [action_events, page_events] = load_events(analytics)
-      action_events.to_sql('action_events', db_engine, schema='public', if_exists='replace', index=False)
-      page_events.to_sql('page_events', db_engine, schema='public', if_exists='replace', index=False)
-
-load_data_directory()
+  connection = db_engine.raw_connection()
+  # Shared by every chunk of every analytics export, rather than started again for each of them
+  json_executor = ProcessPoolExecutor(max_workers=json_workers) if workers == 1 and json_workers > 1 else None
+  try:
+    ensure_ingestion_log(connection)
+    if not incremental:
+      clear_ingestion_log(connection)
+    connection.commit()
+
+    files = []
+    for f in raw_files:
+      file_name = os.path.basename(f)
+      file_loader = get_file_loader(file_name, json_executor, json_workers)
+      if file_loader is None:
+        continue
+      [file_size, content_hash] = fingerprint_file(f)
+      if incremental and is_file_ingested(connection, content_hash):
+        print('Skipped {}, it has already been loaded'.format(file_name))
+        continue
+      files.append([f, file_size, content_hash] + file_loader)
+
+    table_columns = {}
+    loaded_files = []
+    with tempfile.TemporaryDirectory() as chunk_directory, \
+         ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+      if executor is None:
+        normalized_files = ([normalize_chunks(f, loader, chunk_size), None] for [f, _, _, loader, _] in files)
+      else:
+        # The writer below takes the workers' results in order, while they normalize the next files
+        normalized_files = normalize_files_in_pool(executor, [[f, loader] for [f, _, _, loader, _] in files], 2 * workers,
+                                                   chunk_size, chunk_directory)
+
+      for i, [[f, file_size, content_hash, _, table_names], [normalized_chunks, normalize_time]] in enumerate(zip(files, normalized_files)):
+        file_name = os.path.basename(f)
+        start_time = time.perf_counter()
+        [row_count, min_event_time, max_event_time] = load_file(normalized_chunks, table_names, connection,
+                                                                table_columns, incremental, partition_events, remove_duplicates)
+        # Built once the file's rows are in, which is faster than updating them row by row as they are copied
+        for table_name in table_names:
+          for columns in EVENT_INDEXES.get(table_name, []):
+            create_index(table_name, columns, connection)
+        events_since = None if pd.isna(min_event_time) else min_event_time
+        logged_file = [file_name, file_size, content_hash, row_count, None if pd.isna(max_event_time) else max_event_time, events_since]
+        if incremental:
+          # Only the months from the file's earliest event on can have gained events, so only those need adding to the rollup
+          is_analytics = file_name.startswith('analytics')
+          update_user_month_activity(connection, since=events_since if is_analytics else None)
+          if sketch_error is not None and (events_since is not None or not is_analytics):
+            # Loading users may change their countries, which every sketch is split by
+            update_user_sketches(connection, since=events_since if is_analytics else None, error=sketch_error)
+          record_ingested_file(connection, *logged_file)
+        else:
+          loaded_files.append(logged_file)
+        # Each file is loaded in a single transaction, so an interrupted load can simply be run again
+        connection.commit()
+        elapsed = time.perf_counter() - start_time
+        if normalize_time is None:
+          print('[{}/{}] Loaded {} rows from {} in {:.1f}s ({:,.0f} rows/sec)'.format(
+            i + 1, len(files), row_count, file_name, elapsed, row_count / max(elapsed, 1e-9)))
+        else:
+          print('[{}/{}] Loaded {} rows from {}, normalized in {:.1f}s and written in {:.1f}s ({:,.0f} rows/sec written)'.format(
+            i + 1, len(files), row_count, file_name, normalize_time, elapsed, row_count / max(elapsed, 1e-9)))
+
+    if not incremental:
+      # Rebuilt once every file is in, as rebuilding after each file would scan all events loaded so far again.
+      # Files are only logged along with it, so a later incremental load does not take them for fully loaded before then.
+      update_user_month_activity(connection, rebuild=True)
+      if sketch_error is not None:
+        update_user_sketches(connection, error=sketch_error)
+      for logged_file in loaded_files:
+        record_ingested_file(connection, *logged_file)
+      connection.commit()
+  finally:
+    connection.close()
+    if json_executor is not None:
+      json_executor.shutdown()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Load raw analytics and users exports from the data directory into the database.')
+  parser.add_argument('--chunk-size', type=int, default=None,
+                      help='Stream each export in chunks of this many rows and bulk copy them into the database')
+  parser.add_argument('--json-workers', type=int, default=1,
+                      help='Number of processes used to decode the JSON data column of large analytics exports')
+  parser.add_argument('--incremental', action='store_true',
+                      help='Keep the existing tables and only load files and events that have not been loaded yet')
+  parser.add_argument('--parquet-directory', default=None,
+                      help='Write the normalized tables to Parquet datasets in this directory instead of the database')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='Number of processes that parse and normalize exports in parallel, --json-workers only applies if this is 1')
+  parser.add_argument('--sketches', action='store_true',
+                      help='Keep approximate sketches of the users active each day in each country, see user_sketches.py')
+  parser.add_argument('--sketch-error', type=float, default=SKETCH_ERROR,
+                      help='Relative standard error of the user sketches (defaults to the SKETCH_ERROR environment variable or 0.02)')
+  parser.add_argument('--partition-events', action='store_true',
+                      help='Partition the event tables by month, so that date range queries only read the months they cover')
+  parser.add_argument('--remove-duplicates', action='store_true',
+                      help='With --incremental, remove duplicate rows from existing tables instead of stopping, keeping the last copy of each')
+  args = parser.parse_args()
+  load_data_directory(chunk_size=args.chunk_size, json_workers=args.json_workers, incremental=args.incremental,
+                      parquet_directory=args.parquet_directory, workers=args.workers,
+                      sketch_error=args.sketch_error if args.sketches else None, partition_events=args.partition_events,
+                      remove_duplicates=args.remove_duplicates)
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import pickle
+import time
+
+from db_manager import get_data_version, get_sql_engine
+
+'''
+  Caches query results on local disk, keyed by the query and the version of the data in the database,
+  so that rebuilding the dashboard does not run any aggregation query while no new data has been loaded.
+'''
+
+CACHE_DIRECTORY = os.getenv('QUERY_CACHE_DIRECTORY', os.path.join(os.path.dirname(__file__), '../../data/.query_cache'))
+CACHE_MAX_BYTES = int(os.getenv('QUERY_CACHE_MAX_BYTES', 256 * 2**20))
+CACHE_MAX_AGE = int(os.getenv('QUERY_CACHE_MAX_AGE', 7 * 24 * 60 * 60))  # In seconds
+
+cache_stats = {'hits': 0, 'misses': 0}
+
+def get_cache_key(getter, args: tuple, kwargs: dict, engine, data_version: str) -> str:
+  '''
+    Identifies the results of calling `getter` with the given arguments against a database at a given data version
+  '''
+  query_identity = repr([getter.__module__, getter.__qualname__, args, sorted(kwargs.items()),
+                         repr(engine.url), data_version])
+  return hashlib.sha256(query_identity.encode('utf-8')).hexdigest()
+
+def cached_query(getter, engine = None, *args, **kwargs):
+  '''
+    Returns `getter(engine, *args, **kwargs)`, e.g. a DataFrame or a list of DataFrames from db_manager.
+    Results are read from the cache if they were stored since data was last loaded, and stored otherwise.
+  '''
+  if engine is None:
+    engine = get_sql_engine()
+  path = os.path.join(CACHE_DIRECTORY, get_cache_key(getter, args, kwargs, engine, get_data_version(engine)) + '.pickle')
+  try:
+    with open(path, 'rb') as f:
+      results = pickle.load(f)
+    # Keep recently used entries from being evicted
+    os.utime(path)
+    cache_stats['hits'] += 1
+    return results
+  except FileNotFoundError:
+    pass
+  except Exception:
+    # Entries that cannot be read, e.g. truncated ones or ones pickled by other library versions, are misses
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+  cache_stats['misses'] += 1
+  results = getter(engine, *args, **kwargs)
+  os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+  # Write to a temporary file first so concurrent builds never read a partly written entry
+  temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+  with open(temporary_path, 'wb') as f:
+    pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(temporary_path, path)
+  evict_cache_entries()
+  return results
+
+def evict_cache_entries(max_bytes: int = CACHE_MAX_BYTES, max_age: int = CACHE_MAX_AGE):
+  '''
+    Deletes cache entries that have not been used for `max_age` seconds, then the least recently used entries
+    until the cache takes up at most `max_bytes`
+  '''
+  entries = []
+  for entry in os.scandir(CACHE_DIRECTORY):
+    if entry.name.endswith('.pickle'):
+      stat = entry.stat()
+      entries.append([stat.st_mtime, stat.st_size, entry.path])
+  entries.sort()
+
+  now = time.time()
+  total_bytes = sum(size for _, size, _ in entries)
+  for last_used, size, path in entries:
+    if now - last_used <= max_age and total_bytes <= max_bytes:
+      break
+    try:
+      os.remove(path)
+    except OSError:
+      continue
+    total_bytes -= size
@@ -0,0 +1,219 @@
+import datetime
+import math
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+'''
+  Keeps HyperLogLog sketches of the users active each day in each country, an optional approximate alternative to
+  counting distinct users. Sketches are updated as events are loaded and can be merged at query time, so active,
+  new and returning users can be estimated for any date range and group of countries without scanning any events.
+  Load them with `python src/data_processing/load_data.py --sketches`.
+'''
+
+USER_SKETCHES_TABLE = 'user_sketches'
+# Relative standard error of the estimates, which sets the number of registers in each sketch
+SKETCH_ERROR = float(os.getenv('SKETCH_ERROR', 0.02))
+# Stored as the country of users without one, as the country is part of the primary key
+UNKNOWN_COUNTRY = ''
+# Number of rows fetched from the database at a time while building sketches
+SKETCH_BATCH_SIZE = 100000
+# Period lengths the estimates can be grouped by
+SKETCH_GRANULARITIES = {'day': 'D', 'week': 'W', 'month': 'M'}
+
+def get_precision(error: float) -> int:
+  '''
+    Returns the smallest number of index bits giving sketches a relative standard error of at most `error`.
+    A sketch with 2^precision registers has a relative standard error of 1.04 / sqrt(2^precision).
+  '''
+  return min(max(math.ceil(math.log2((1.04 / error) ** 2)), 4), 18)
+
+def hash_user_ids(user_ids) -> np.ndarray:
+  '''
+    Returns a 64-bit hash of each user id, which is the same in every process
+  '''
+  return pd.util.hash_array(np.asarray(user_ids, dtype=object))
+
+def build_registers(hashes: np.ndarray, groups: np.ndarray, group_count: int, precision: int) -> np.ndarray:
+  '''
+    Builds a sketch for each of `group_count` groups, where `groups` is the group of each hash.
+    Returns a (group_count, 2^precision) array with the registers of each sketch.
+  '''
+  register_count = 1 << precision
+  rank_bits = 64 - precision
+  index = (hashes >> np.uint64(rank_bits)).astype(np.int64)
+  remaining = hashes & np.uint64((1 << rank_bits) - 1)
+  # The rank is the position of the first set bit after the index bits
+  bit_length = np.minimum(np.frexp(remaining.astype(np.float64))[1], rank_bits)
+  rank = (rank_bits - bit_length + 1).astype(np.uint8)
+  max_rank = pd.Series(rank).groupby(groups.astype(np.int64) * register_count + index).max()
+  registers = np.zeros((group_count, register_count), dtype=np.uint8)
+  registers.reshape(-1)[max_rank.index.to_numpy()] = max_rank.to_numpy()
+  return registers
+
+def estimate_distinct_count(registers: np.ndarray) -> np.ndarray:
+  '''
+    Estimates the number of distinct users added to each sketch along the last axis of `registers`
+  '''
+  register_count = registers.shape[-1]
+  alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(register_count, 0.7213 / (1 + 1.079 / register_count))
+  raw_estimate = alpha * register_count ** 2 / np.sum(np.exp2(-registers.astype(np.float64)), axis=-1)
+  # Small counts leave many registers empty, and are estimated more accurately from the number of empty registers
+  empty_registers = np.count_nonzero(registers == 0, axis=-1)
+  linear_estimate = register_count * np.log(register_count / np.maximum(empty_registers, 1))
+  return np.where((raw_estimate <= 2.5 * register_count) & (empty_registers > 0), linear_estimate, raw_estimate)
+
+def to_bytes(registers: np.ndarray) -> bytes:
+  # Sketches of days with few users are mostly empty registers, which compress well
+  return zlib.compress(registers.astype(np.uint8).tobytes())
+
+def from_bytes(data: bytes) -> np.ndarray:
+  return np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+
+def ensure_user_sketches(connection):
+  '''
+    Creates the sketch table if it does not exist yet
+  '''
+  with connection.cursor() as cursor:
+    cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS public.{} (
+                      day DATE NOT NULL,
+                      country TEXT NOT NULL,
+                      precision SMALLINT NOT NULL,
+                      registers BYTEA NOT NULL,
+                      PRIMARY KEY (day, country)
+                    )
+                    '''.format(USER_SKETCHES_TABLE))
+
+def update_user_sketches(connection, since: datetime.datetime = None, error: float = SKETCH_ERROR):
+  '''
+    Adds the users active at or after `since` to the sketch of each day and country they were active in.
+    Sketches are merged by keeping the largest value of each register, so adding users that are already in a sketch
+    changes nothing. Every sketch is rebuilt from all of action_events instead if `since` is None, e.g. after the
+    country of users may have changed, or if the sketches were built for a different error.
+  '''
+  precision = get_precision(error)
+  with connection.cursor() as cursor:
+    cursor.execute("SELECT to_regclass('public.action_events') IS NULL, to_regclass('public.users') IS NULL")
+    [no_events, no_users] = cursor.fetchone()
+    if no_events:
+      return
+    ensure_user_sketches(connection)
+    cursor.execute('SELECT DISTINCT precision FROM public.{}'.format(USER_SKETCHES_TABLE))
+    rebuild = since is None or any(row[0] != precision for row in cursor.fetchall())
+    if rebuild:
+      cursor.execute('TRUNCATE public.{}'.format(USER_SKETCHES_TABLE))
+
+  # Users are counted in the same country as in user_month_activity
+  country_join = '' if no_users else '''
+                                      LEFT JOIN (
+                                        SELECT user_id, MAX(country) AS country
+                                        FROM users
+                                        GROUP BY user_id
+                                      ) countries ON countries.user_id = events.user_id
+                                      '''
+  sketches = {}
+  with connection.cursor(name='user_sketch_events') as cursor:
+    cursor.itersize = SKETCH_BATCH_SIZE
+    cursor.execute('''
+                    SELECT DISTINCT events.user_id, CAST(events.time AS DATE) AS day, {} AS country
+                    FROM action_events events
+                    {}
+                    WHERE %(rebuild)s OR events.time >= %(since)s
+                    '''.format('NULL' if no_users else 'countries.country', country_join), {'rebuild': rebuild, 'since': since})
+    rows = cursor.fetchmany(SKETCH_BATCH_SIZE)
+    while rows:
+      batch = pd.DataFrame.from_records(rows, columns=['user_id', 'day', 'country']).fillna({'country': UNKNOWN_COUNTRY})
+      groups = batch.groupby(['day', 'country'], sort=False).ngroup().to_numpy()
+      keys = batch[['day', 'country']].drop_duplicates().itertuples(index=False, name=None)
+      registers = build_registers(hash_user_ids(batch['user_id']), groups, groups.max() + 1, precision)
+      for key, key_registers in zip(keys, registers):
+        sketches[key] = np.maximum(sketches[key], key_registers) if key in sketches else key_registers
+      rows = cursor.fetchmany(SKETCH_BATCH_SIZE)
+  if not sketches:
+    return
+
+  # psycopg2 is only needed by (and only imported for) loads into Postgres
+  from psycopg2.extras import execute_values
+  with connection.cursor() as cursor:
+    if not rebuild:
+      cursor.execute('SELECT day, country, registers FROM public.{} WHERE day >= %s'.format(USER_SKETCHES_TABLE), (since.date(),))
+      for day, country, data in cursor.fetchall():
+        if (day, country) in sketches:
+          sketches[day, country] = np.maximum(sketches[day, country], from_bytes(data))
+    execute_values(cursor, '''
+                            INSERT INTO public.{} (day, country, precision, registers) VALUES %s
+                            ON CONFLICT (day, country) DO UPDATE
+                            SET precision = EXCLUDED.precision, registers = EXCLUDED.registers
+                            '''.format(USER_SKETCHES_TABLE),
+                   [(day, country, precision, to_bytes(registers)) for (day, country), registers in sketches.items()])
+
+def read_sketches(engine, end_date: datetime.date = None, countries: list = None) -> [pd.DataFrame, np.ndarray]:
+  '''
+    Returns the day and country of every stored sketch up to `end_date` in the given countries (or all countries),
+    ordered by day, along with an array of their registers with one row per sketch
+  '''
+  sql = sqlalchemy.sql.text('''
+                              SELECT day, country, precision, registers
+                              FROM {}
+                              WHERE (:end_date IS NULL OR day <= :end_date)
+                              ORDER BY day
+                            '''.format(USER_SKETCHES_TABLE)).bindparams(end_date=end_date)
+  with engine.connect() as connection:
+    rows = connection.execute(sql).fetchall()
+  sketches = pd.DataFrame.from_records(rows, columns=['day', 'country', 'precision', 'registers'])
+  if countries is not None:
+    sketches = sketches[sketches['country'].isin(countries)]
+  if sketches['precision'].nunique() > 1:
+    raise ValueError('The stored sketches were built with different errors, rebuild them with update_user_sketches')
+  register_count = 1 << int(sketches['precision'].iloc[0]) if len(sketches) else 1
+  registers = np.stack([from_bytes(data) for data in sketches['registers']]) if len(sketches) else np.zeros((0, register_count), dtype=np.uint8)
+  return [sketches[['day', 'country']].reset_index(drop=True), registers]
+
+def estimate_active_users(engine, start_date: datetime.date = None, end_date: datetime.date = None, countries: list = None) -> int:
+  '''
+    Estimates the number of distinct users active from `start_date` to `end_date` (inclusive) in the given countries
+  '''
+  [keys, registers] = read_sketches(engine, end_date, countries)
+  if start_date is not None:
+    registers = registers[(keys['day'] >= start_date).to_numpy()]
+  if len(registers) == 0:
+    return 0
+  return int(np.round(estimate_distinct_count(registers.max(axis=0))))
+
+def get_estimated_active_users(engine, granularity: str = 'month', start_date: datetime.date = None, end_date: datetime.date = None,
+                               countries: list = None) -> pd.DataFrame:
+  '''
+    Estimates the number of users active in each day, week or month (see SKETCH_GRANULARITIES) from `start_date` to `end_date`,
+    in the given countries or all countries, with columns:
+      - date, the first day of each period
+      - count, the users active in the period
+      - new_count, the users first active in the period, the users active up to the end of the period less those
+        active before it
+      - returning_count, the users active in the period that were also active before it
+  '''
+  [keys, registers] = read_sketches(engine, end_date, countries)
+  columns = ['date', 'count', 'new_count', 'returning_count']
+  if len(registers) == 0:
+    return pd.DataFrame(columns=columns)
+  periods = pd.PeriodIndex(pd.to_datetime(keys['day']), freq=SKETCH_GRANULARITIES[granularity])
+  # Sketches are ordered by day, so each period's sketches are contiguous
+  [period_starts] = np.nonzero(np.r_[True, periods[1:] != periods[:-1]])
+  period_registers = np.maximum.reduceat(registers, period_starts, axis=0)
+  cumulative_registers = np.maximum.accumulate(period_registers, axis=0)
+
+  counts = estimate_distinct_count(period_registers)
+  cumulative_counts = estimate_distinct_count(cumulative_registers)
+  new_counts = np.clip(cumulative_counts - np.r_[0, cumulative_counts[:-1]], 0, counts)
+  estimates = pd.DataFrame({
+    'date': periods[period_starts].to_timestamp(),
+    'count': np.round(counts).astype(np.int64),
+    'new_count': np.round(new_counts).astype(np.int64),
+  })
+  estimates['returning_count'] = estimates['count'] - estimates['new_count']
+  if start_date is not None:
+    estimates = estimates[estimates['date'] >= pd.Period(start_date, freq=SKETCH_GRANULARITIES[granularity]).to_timestamp()]
+  return estimates.reset_index(drop=True)
@@ -0,0 +1,56 @@
+import os
+import sys
+
+from bokeh.io import curdoc
+from bokeh.models import Column, Div, Row
+
+# `bokeh serve` does not add this directory to the import path like `python src/main.py` does,
+# and the data processing modules are imported as top-level modules, see main.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_processing'))
+
+import live_aggregates
+from visualization import monthly_user_map, monthly_user_plot
+
+'''
+  A live version of the dashboard, which updates in place as new data is loaded.
+  Run it with `bokeh serve src/live_dashboard.py`.
+  Every session shares the aggregates refreshed by one background thread, see data_processing/live_aggregates.py.
+'''
+
+# How often each session checks for new aggregates, in milliseconds
+UPDATE_INTERVAL = 1000
+
+live_aggregates.start_background_refresh()
+# Sessions are built on the server's event loop, so they must not wait for a database that is down
+[revision, aggregates] = live_aggregates.get_latest_aggregates(live_aggregates.FIRST_REFRESH_TIMEOUT)
+if aggregates is None:
+  # Shown empty until update() receives the first aggregates
+  aggregates = live_aggregates.get_empty_aggregates()
+[total_monthly_users, _, total_returning_users, total_monthly_users_by_country, total_new_monthly_users_by_country] = aggregates
+session = {'revision': revision}
+
+[map_row, widget_row] = monthly_user_map.plot_totals(total_monthly_users_by_country, total_new_monthly_users_by_country)
+monthly_bar_plot_figure = monthly_user_plot.plot_totals(total_monthly_users, total_returning_users)
+monthly_bar_plot_figure.sizing_mode="stretch_width"
+
+def update():
+  '''
+    Sends the changes of any newer aggregates to this session's plots
+  '''
+  [revision, aggregates] = live_aggregates.get_latest_aggregates(timeout=0)
+  if aggregates is None or revision == session['revision']:
+    return
+  session['revision'] = revision
+  [total_monthly_users, _, total_returning_users, total_monthly_users_by_country, total_new_monthly_users_by_country] = aggregates
+  monthly_user_map.update_totals(map_row, widget_row, total_monthly_users_by_country, total_new_monthly_users_by_country)
+  monthly_user_plot.update_totals(monthly_bar_plot_figure, total_monthly_users, total_returning_users)
+
+curdoc().add_root(Column(
+      Row(Div(text='<strong>Users by Country</strong>')),
+      widget_row,
+      map_row,
+      Row(Div(text='<strong>Users by Month</strong>', margin=(25, 0, 0, 0))),
+      monthly_bar_plot_figure
+    ))
+curdoc().add_periodic_callback(update, UPDATE_INTERVAL)
@@ -1,20 +1,44 @@
+import argparse
+import datetime
+import os
+import sys
+
 from bokeh.models import Column, Div, Row
 from bokeh.plotting import show
 
-from data_processing import db_manager
+# The data processing modules import each other as top-level modules, as they do when run as scripts,
+# so they are imported the same way here rather than as a package, which would load a second copy of each
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_processing'))
+
+import db_manager
+import query_cache
 from visualization import monthly_user_map, monthly_user_plot
 
+parser = argparse.ArgumentParser(description='Build the dashboard and open it in a browser.')
+parser.add_argument('--granularity', choices=db_manager.GRANULARITIES, default='month',
+                    help='Length of the periods users are counted in')
+parser.add_argument('--start-date', type=datetime.date.fromisoformat, default=None,
+                    help='Only count users from the period containing this date (YYYY-MM-DD) onwards')
+parser.add_argument('--end-date', type=datetime.date.fromisoformat, default=None,
+                    help='Only count users up to the period containing this date (YYYY-MM-DD)')
+parser.add_argument('--last-days', type=int, default=None,
+                    help='Only count users from this many days before the end date (or today), e.g. `--last-days 30 --granularity day`')
+args = parser.parse_args()
+start_date = args.start_date
+if args.last_days is not None:
+  start_date = (args.end_date or datetime.date.today()) - datetime.timedelta(days=args.last_days - 1)
+
 engine = db_manager.get_sql_engine()
+[total_monthly_users, _, total_returning_users,
+ total_monthly_users_by_country, total_new_monthly_users_by_country] = query_cache.cached_query(
+  db_manager.get_dashboard_aggregates, engine, start_date, args.end_date, args.granularity)
+print('Query cache: {hits} hits, {misses} misses'.format(**query_cache.cache_stats))
 
 # Generate the map plot
-total_monthly_users_by_country = db_manager.get_total_monthly_users_by_country(engine)
-total_new_monthly_users_by_country = db_manager.get_total_new_monthly_users_by_country(engine)
-[map_row, widget_row] = monthly_user_map.plot_totals(total_monthly_users_by_country, total_new_monthly_users_by_country)
+[map_row, widget_row] = monthly_user_map.plot_totals(total_monthly_users_by_country, total_new_monthly_users_by_country, args.granularity)
 
 # Generate the bar chart plot
-total_monthly_users = db_manager.get_total_monthly_users(engine)
-total_returning_users = db_manager.get_total_returning_monthly_users(engine)
-monthly_bar_plot_figure = monthly_user_plot.plot_totals(total_monthly_users, total_returning_users)
+monthly_bar_plot_figure = monthly_user_plot.plot_totals(total_monthly_users, total_returning_users, args.granularity)
 monthly_bar_plot_figure.sizing_mode="stretch_width"
 
 # Layout and display
@@ -22,6 +46,6 @@ show(Column(
       Row(Div(text='<strong>Users by Country</strong>')),
       widget_row,
       map_row,
-      Row(Div(text='<strong>Users by Month</strong>', margin=(25, 0, 0, 0))),
+      Row(Div(text='<strong>Users by {}</strong>'.format(args.granularity.capitalize()), margin=(25, 0, 0, 0))),
       monthly_bar_plot_figure
     ))
@@ -1,143 +1,213 @@
-import datetime
+import functools
 import json
 import locale
+import math
 import os
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 import geopandas as gpd
 import pandas as pd
 from bokeh.io import output_file, output_notebook, show
-from bokeh.models import (ColorBar, CustomJS, GeoJSONDataSource, HoverTool,
+from bokeh.models import (ColorBar, ColumnDataSource, CustomJS, HoverTool,
                           LinearColorMapper, Panel, RadioButtonGroup, Row,
                           Select, Tabs)
 from bokeh.palettes import brewer
 from bokeh.plotting import figure
 
 
-def plot_map(user_counts: pd.DataFrame, month_to_show: int, color_palette: str) -> figure:
+SHAPEFILE = os.path.join(os.path.dirname(__file__), '../../data/ne_110m_admin_0_countries/ne_110m_admin_0_countries.shp')
+# Country shapes ready to be plotted, rebuilt whenever the shapefile changes
+GEOMETRY_CACHE_FILE = os.path.join(os.path.dirname(__file__), '../../data/.cache/country_geometry.json')
+
+def read_country_geometry(shapefile: str) -> Dict[str, list]:
   '''
-    Plots the number of users per country on a world map
-    - user_counts contains the total number of users, per country, per month
-    - month_to_show is the month of data from user_counts that should be plotted
-    - color_palette is the color palette for drawing the user counts
+    Reads the country shapes from a shapefile into the columns of a patches data source:
+    - country and country_code, the name and ISO 3166-1 alpha-2 code of each country
+    - xs and ys, the outline of each country, with NaN separating the parts of countries made of several polygons
   '''
-  script_directory = os.path.dirname(__file__)
-  shapefile = os.path.join(script_directory, '../../data/ne_110m_admin_0_countries/ne_110m_admin_0_countries.shp')
-
   gdf = gpd.read_file(shapefile)[['ADMIN', 'ISO_A2', 'geometry']]
   gdf.columns = ['country', 'country_code', 'geometry']
-  gdf[gdf['country'] == 'Antarctica'].index
   gdf = gdf.drop(gdf[gdf['country'] == 'Antarctica'].index) # No data and clutters the plot
 
-  user_month_data = user_counts[user_counts['month'] == month_to_show]
-  data_gdf = gdf.merge(user_month_data, left_on = 'country_code', right_on = 'country', how = 'left')
-  data_gdf['count'].fillna(0, inplace = True)
+  xs = []
+  ys = []
+  for geometry in gdf['geometry']:
+    polygons = geometry.geoms if geometry.geom_type == 'MultiPolygon' else [geometry]
+    country_xs = []
+    country_ys = []
+    for polygon in polygons:
+      if country_xs:
+        country_xs.append(math.nan)
+        country_ys.append(math.nan)
+      [polygon_xs, polygon_ys] = polygon.exterior.coords.xy
+      country_xs.extend(polygon_xs)
+      country_ys.extend(polygon_ys)
+    xs.append(country_xs)
+    ys.append(country_ys)
+  return {'country': gdf['country'].tolist(), 'country_code': gdf['country_code'].tolist(), 'xs': xs, 'ys': ys}
+
+@functools.lru_cache(maxsize=None)
+def load_country_geometry() -> Dict[str, list]:
+  '''
+    Returns the country shapes (see read_country_geometry), which are only read once per process.
+    The shapes are also stored in GEOMETRY_CACHE_FILE, so the shapefile is only parsed again when it changes.
+    Callers must not modify the returned lists, as they are shared by every map.
+  '''
+  shapefile_mtime = os.path.getmtime(SHAPEFILE)
+  try:
+    with open(GEOMETRY_CACHE_FILE) as f:
+      cached = json.load(f)
+    if cached['shapefile_mtime'] == shapefile_mtime:
+      return cached['geometry']
+  except (OSError, ValueError, KeyError):
+    pass
+
+  geometry = read_country_geometry(SHAPEFILE)
+  os.makedirs(os.path.dirname(GEOMETRY_CACHE_FILE), exist_ok=True)
+  temporary_path = '{}.{}.tmp'.format(GEOMETRY_CACHE_FILE, os.getpid())
+  with open(temporary_path, 'w') as f:
+    json.dump({'shapefile_mtime': shapefile_mtime, 'geometry': geometry}, f)
+  os.replace(temporary_path, GEOMETRY_CACHE_FILE)
+  return geometry
+
+# Types of data that can be shown on the map, with their button labels, tooltip labels and color palettes
+MAP_METRICS = [('total', 'Total Users', 'Total User Count', 'Blues'), ('new', 'New Users', 'New User Count', 'Oranges')]
+
+def get_count_column(metric: str, period_index: int) -> str:
+  '''
+    Returns the name of the map data column holding the user counts of a metric for the period at `period_index`
+  '''
+  return '{}_{}'.format(metric, period_index)
 
-  json_data = json.dumps(json.loads(data_gdf.to_json()))
-  geosource = GeoJSONDataSource(geojson = json_data)
+def get_palette(color_palette: str) -> List[str]:
   palette = brewer[color_palette][8]
-  palette = palette[::-1] # More users = darker colours
-  color_mapper = LinearColorMapper(palette = palette, low = 0, high = user_month_data['count'].max())
-
-  hover = HoverTool(tooltips=[('Country', '@country_x'), ('Total User Count', '@count')])
+  return palette[::-1] # More users = darker colours
 
-  p = figure(plot_height = 600 , plot_width = 1150, toolbar_location = None, tools = [hover])
-  p.patches('xs','ys', source = geosource,fill_color = {'field' :'count', 'transform' : color_mapper},
-            line_color = 'black', line_width = 0.25, fill_alpha = 1)
-  return p
+# Formats of the labels of the periods of each granularity (see db_manager.GRANULARITIES) in the period dropdown
+PERIOD_LABEL_FORMATS = {'day': '%d %B %Y', 'week': 'Week of %d %B %Y', 'month': '%B %Y'}
 
-def plot_all_month_maps(user_counts: pd.DataFrame, color_palette: str) -> [List[figure], List[Tuple[str, str]]]:
+def get_period_counts(user_counts: pd.DataFrame, date: pd.Timestamp, country_codes: List[str]) -> List[int]:
   '''
-    Plot each month on an individual map
-    - user_counts contains the total number of users, per country, per month
-    - color_palette is the color palette for drawing the user counts
+    Returns the user count of each country in `country_codes` for the period starting on `date`, or 0 for countries without users
   '''
-  maps = []
-  map_labels = []
-  for month in user_counts['month'].unique():
-    month_name = datetime.date(1900, month, 1).strftime('%B')
-    map_plot = plot_map(user_counts, month, color_palette)
-    map_plot.visible = False
-    maps.append(map_plot)
-    map_labels.append((str(len(map_labels)), month_name))
-  return [maps, map_labels]
+  user_period_data = user_counts[user_counts['date'] == date]
+  period_counts = dict(zip(user_period_data['country'].astype(str), user_period_data['count']))
+  return [int(period_counts.get(code, 0)) for code in country_codes]
 
-def plot_total_monthly_users(total_monthly_users_by_country: pd.DataFrame) -> [List[figure], List[Tuple[str, str]]]:
+def get_map_data(total_monthly_users_by_country: pd.DataFrame, total_new_monthly_users_by_country: pd.DataFrame,
+                 granularity: str = 'month') -> [Dict[str, list], List[Tuple[str, str]]]:
   '''
-    Helper function to draw the total monthly users by country with the correct palette
+    Builds the data of the map, which has the shape of every country and one column of user counts per metric per period
+    (see get_count_column), along with the labels of the periods in the order of their indices
   '''
-  return plot_all_month_maps(total_monthly_users_by_country, 'Blues')
-
-def plot_total_new_monthly_users(total_new_monthly_users_by_country: pd.DataFrame) -> [List[figure], List[Tuple[str, str]]]:
+  data = dict(load_country_geometry())
+  period_labels = []
+  for period_index, date in enumerate(total_monthly_users_by_country['date'].unique()):
+    for [metric, _, _, _], user_counts in zip(MAP_METRICS, [total_monthly_users_by_country, total_new_monthly_users_by_country]):
+      data[get_count_column(metric, period_index)] = get_period_counts(user_counts, date, data['country_code'])
+    period_labels.append((str(period_index), pd.Timestamp(date).strftime(PERIOD_LABEL_FORMATS[granularity])))
+  return [data, period_labels]
+
+def plot_map(source: ColumnDataSource, count_column: str, tooltip_label: str, color_mapper: LinearColorMapper) -> figure:
   '''
-    Helper function to draw the total new monthly users by country with the correct palette
+    Plots the number of users per country on a world map
+    - source contains the shape of every country and their user counts
+    - count_column is the column of source that is initially plotted, described by tooltip_label
+    - color_mapper maps the user counts to colors
   '''
-  return plot_all_month_maps(total_new_monthly_users_by_country, 'Oranges')
+  hover = HoverTool(tooltips=[('Country', '@country'), (tooltip_label, '@{' + count_column + '}')])
+
+  p = figure(plot_height = 600 , plot_width = 1150, toolbar_location = None, tools = [hover])
+  p.patches('xs','ys', source = source,fill_color = {'field' : count_column, 'transform' : color_mapper},
+            line_color = 'black', line_width = 0.25, fill_alpha = 1)
+  return p
 
-def get_plot_widget_row(total_monthly_users_by_country_maps: List[figure], total_new_monthly_users_by_country_maps: List[figure], map_labels: List[Tuple[str, str]]) -> Row:
+def get_plot_widget_row(map_plot: figure, source: ColumnDataSource, color_mapper: LinearColorMapper, map_labels: List[Tuple[str, str]]) -> Row:
   '''
-    Creates two widgets that jointly control which map plot is displayed.
-    A dropdown menu selects which month of data will be shown.
+    Creates two widgets that jointly control which data is displayed on the map.
+    A dropdown menu selects which period of data will be shown.
     A radio button group selects which type of data will be shown (i.e. all users vs new users)
+    Both only switch the column of the data source that the countries are colored by.
   '''
-  active_maps = 0
-  active_month = '0'
+  radiogroup = RadioButtonGroup(labels = [label for _, label, _, _ in MAP_METRICS], active = 0)
+  select = Select(value = map_labels[0][0] if map_labels else '0', options=map_labels)
 
   callback = CustomJS(args = dict(
-                                  active_maps = active_maps, 
-                                  active_month = active_month, 
-                                  total_maps = total_monthly_users_by_country_maps, 
-                                  new_maps = total_new_monthly_users_by_country_maps
-                                ), 
+                                  source = source,
+                                  renderer = map_plot.renderers[0],
+                                  hover = map_plot.hover[0],
+                                  color_mapper = color_mapper,
+                                  radiogroup = radiogroup,
+                                  select = select,
+                                  metrics = [metric for metric, _, _, _ in MAP_METRICS],
+                                  tooltip_labels = [tooltip_label for _, _, tooltip_label, _ in MAP_METRICS],
+                                  palettes = [get_palette(color_palette) for _, _, _, color_palette in MAP_METRICS]
+                                ),
                       code = """
-                              // Initial setup for shared vars
-                              // Need to use global vars to share state between multiple widgets
-                              if (!window.active_maps) {
-                                window.active_maps = active_maps
-                              }
-                              if (!window.active_month) {
-                                window.active_month = active_month
-                              }
-                              if (cb_obj.value !== undefined) {
-                                // Changing map type displayed
-                                if (window.active_maps == 0) {
-                                  total_maps[window.active_month].visible = false;
-                                  total_maps[cb_obj.value].visible = true;
-                                } else if (window.active_maps == 1) {
-                                  new_maps[window.active_month].visible = false;
-                                  new_maps[cb_obj.value].visible = true;
-                                }
-                                window.active_month = cb_obj.value;
-                              } else if (cb_obj.active !== undefined) {
-                                // Changing month displayed
-                                if (cb_obj.active == 0) {
-                                  total_maps[window.active_month].visible = true
-                                  new_maps[window.active_month].visible = false;
-                                } else if (cb_obj.active == 1) {
-                                  new_maps[window.active_month].visible = true; 
-                                  total_maps[window.active_month].visible = false;
-                                }
-                                window.active_maps = cb_obj.active;
-                              }
+                              const field = metrics[radiogroup.active] + '_' + select.value
+                              const counts = source.data[field]
+                              color_mapper.palette = palettes[radiogroup.active]
+                              color_mapper.high = Math.max(...counts)
+                              renderer.glyph.fill_color = {field: field, transform: color_mapper}
+                              hover.tooltips = [['Country', '@country'], [tooltip_labels[radiogroup.active], '@{' + field + '}']]
                               """
                       )
-
-  radiogroup = RadioButtonGroup(labels = ["Total Users", "New Users"], active = active_maps)
   radiogroup.js_on_click(callback)
-
-  select = Select(value = active_month, options=map_labels)
   select.js_on_change('value', callback)
 
   widget_row = Row(select, radiogroup)
   return widget_row
 
-def plot_totals(total_monthly_users_by_country: pd.DataFrame, total_new_monthly_users_by_country: pd.DataFrame) -> [Row, Row]:
+def plot_totals(total_monthly_users_by_country: pd.DataFrame, total_new_monthly_users_by_country: pd.DataFrame,
+                granularity: str = 'month') -> [Row, Row]:
   '''
-    Plot all users by country on a map and return layout components with the maps and their associated control widgets.
+    Plot all users by country on a map and return layout components with the map and its associated control widgets.
+    A single map and data source hold every period of data, so the output size does not grow with the number of periods.
   '''
-  [total_monthly_users_by_country_maps, map_labels] = plot_total_monthly_users(total_monthly_users_by_country)
-  [total_new_monthly_users_by_country_maps, _] = plot_total_new_monthly_users(total_new_monthly_users_by_country)
-  total_monthly_users_by_country_maps[0].visible = True
-
-  map_row = Row(*total_monthly_users_by_country_maps, *total_new_monthly_users_by_country_maps)
-  return [map_row, get_plot_widget_row(total_monthly_users_by_country_maps, total_new_monthly_users_by_country_maps, map_labels)]
+  [data, map_labels] = get_map_data(total_monthly_users_by_country, total_new_monthly_users_by_country, granularity)
+  source = ColumnDataSource(data)
+  [metric, _, tooltip_label, color_palette] = MAP_METRICS[0]
+  count_column = get_count_column(metric, 0)
+  color_mapper = LinearColorMapper(palette = get_palette(color_palette), low = 0, high = max(data.get(count_column, [0])))
+  map_plot = plot_map(source, count_column, tooltip_label, color_mapper)
+
+  map_row = Row(map_plot)
+  return [map_row, get_plot_widget_row(map_plot, source, color_mapper, map_labels)]
+
+def update_totals(map_row: Row, widget_row: Row, total_monthly_users_by_country: pd.DataFrame, total_new_monthly_users_by_country: pd.DataFrame,
+                  granularity: str = 'month'):
+  '''
+    Brings a map created by plot_totals up to date with newer user counts.
+    Counts that changed are patched and the columns of new periods are added, rather than replacing the whole data source.
+  '''
+  map_plot = map_row.children[0]
+  renderer = map_plot.renderers[0]
+  source = renderer.data_source
+  select = widget_row.children[0]
+  [data, map_labels] = get_map_data(total_monthly_users_by_country, total_new_monthly_users_by_country, granularity)
+  plotted_labels = [tuple(label) for label in select.options]
+  if map_labels[:len(plotted_labels)] != plotted_labels:
+    # Periods were added before the plotted ones, so the period indices of every count column changed
+    source.data = data
+  else:
+    new_columns = {}
+    patches = {}
+    for column, counts in data.items():
+      if column in ('country', 'country_code', 'xs', 'ys'):
+        continue
+      if column not in source.data:
+        new_columns[column] = counts
+        continue
+      changes = [(i, count) for i, (plotted_count, count) in enumerate(zip(source.data[column], counts)) if plotted_count != count]
+      if changes:
+        patches[column] = changes
+    if new_columns:
+      # A single update only sends the new columns, setting each column would send the whole source (and every shape) again
+      source.data.update(new_columns)
+    if patches:
+      source.patch(patches)
+  select.options = map_labels
+
+  fill_color = renderer.glyph.fill_color
+  if fill_color['field'] in source.data:
+    fill_color['transform'].high = max(source.data[fill_color['field']])
@@ -1,24 +1,57 @@
 import pandas as pd
-from bokeh.models import ColumnDataSource, HoverTool, SingleIntervalTicker
+from bokeh.models import ColumnDataSource, HoverTool
 from bokeh.plotting import figure, output_file, show
 
+# Width of the bars of each granularity (see db_manager.GRANULARITIES), half the length of their period in milliseconds
+BAR_WIDTHS = {'day': 0.5 * 86400000, 'week': 3.5 * 86400000, 'month': 15 * 86400000}
 
-def plot_totals(total_monthly_users: pd.DataFrame, total_returning_users: pd.DataFrame) -> figure:
+def plot_totals(total_monthly_users: pd.DataFrame, total_returning_users: pd.DataFrame, granularity: str = 'month') -> figure:
   '''
-    Plot all user totals by month and return the plot.
+    Plot all user totals by period and return the plot.
+    Periods are placed by their date, so periods from different years never overlap.
   '''
-  p = figure(toolbar_location = None)
-  p.xaxis.ticker = SingleIntervalTicker(interval=1)
+  p = figure(toolbar_location = None, x_axis_type = 'datetime')
 
   total_monthly_users_source = ColumnDataSource(total_monthly_users)
-  bar_renderer = p.vbar(x = 'month', top = 'count', width = 0.5, legend_label = 'Total Users', source = total_monthly_users_source)
+  bar_renderer = p.vbar(x = 'date', top = 'count', width = BAR_WIDTHS[granularity], legend_label = 'Total Users', source = total_monthly_users_source)
   bar_hover = HoverTool(tooltips=[('Total User Count', '@count')], renderers=[bar_renderer])
   p.add_tools(bar_hover)
 
   total_returning_users_source = ColumnDataSource(total_returning_users)
-  p.line(x = 'month', y = 'count', color = 'black', source = total_returning_users_source)
+  p.line(x = 'date', y = 'count', color = 'black', source = total_returning_users_source)
 
-  circle_renderer = p.circle(x = 'month', y = 'count', size=10, color = 'black', hover_color = 'red', legend_label = 'Returning Users', source = total_returning_users_source)
+  circle_renderer = p.circle(x = 'date', y = 'count', size=10, color = 'black', hover_color = 'red', legend_label = 'Returning Users', source = total_returning_users_source)
   circle_hover = HoverTool(tooltips=[('Returning User Count', '@count')], renderers=[circle_renderer])
   p.add_tools(circle_hover)
   return p
+
+def update_source(source: ColumnDataSource, df: pd.DataFrame):
+  '''
+    Brings a source created from a DataFrame of periods up to date with a newer version of that DataFrame.
+    Periods that are already plotted are patched where their values changed and new periods are streamed,
+    so only the changes are sent to the browser.
+  '''
+  data = ColumnDataSource.from_df(df)
+  plotted_periods = [pd.Timestamp(date) for date in source.data['date']]
+  periods = list(df['date'])
+  if periods[:len(plotted_periods)] != plotted_periods:
+    source.data = data
+    return
+
+  patches = {}
+  for column, values in data.items():
+    changes = [(i, value) for i, (plotted_value, value) in enumerate(zip(source.data[column], values)) if plotted_value != value]
+    if changes:
+      patches[column] = changes
+  if patches:
+    source.patch(patches)
+  if len(periods) > len(plotted_periods):
+    source.stream({column: values[len(plotted_periods):] for column, values in data.items()})
+
+def update_totals(p: figure, total_monthly_users: pd.DataFrame, total_returning_users: pd.DataFrame):
+  '''
+    Brings a plot created by plot_totals up to date with newer user totals
+  '''
+  [bar_renderer, line_renderer] = p.renderers[:2]
+  update_source(bar_renderer.data_source, total_monthly_users)
+  update_source(line_renderer.data_source, total_returning_users)
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+'''
+  Makes the data processing modules importable by the tests, as they import each other
+  as top-level modules (e.g. `from db_manager import ...`), like benchmarks/common.py does.
+'''
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+for directory in [SRC_DIRECTORY, os.path.join(SRC_DIRECTORY, 'data_processing'), os.path.join(SRC_DIRECTORY, 'benchmarks')]:
+  if directory not in sys.path:
+    sys.path.insert(0, directory)
+
+@pytest.fixture(scope='session')
+def normalized_exports() -> dict:
+  '''
+    Returns the tables normalized from a small synthetic analytics and users export, by table name
+  '''
+  from load_data import load_events, load_users_and_devices
+  from synthetic import generate_analytics, generate_users
+
+  [action_events, page_events] = load_events(generate_analytics(20000, user_count=500))
+  [user_info, device_info] = load_users_and_devices(generate_users(500))
+  return {'action_events': action_events, 'page_events': page_events, 'users': user_info, 'devices': device_info}
+
+def write_tables(tables: dict, directory: str, basename: str):
+  '''
+    Writes tables to a Parquet dataset per table in `directory`, like `load_data.py --parquet-directory` does
+  '''
+  from db_manager import write_parquet_table
+  from load_data import EVENT_TABLES
+
+  for table_name, df in tables.items():
+    write_parquet_table(df, table_name, directory, basename, partition_column='time' if table_name in EVENT_TABLES else None)
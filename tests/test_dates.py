@@ -0,0 +1,64 @@
+from datetime import datetime, timezone
+
+import pandas as pd
+import pytest
+
+from load_data import convert_to_datetime, parse_text_dates
+from synthetic import generate_timestamps
+
+def parse_with_strptime(value: str) -> datetime:
+  '''
+    Parses a date in either export format one row at a time, as convert_to_datetime used to
+  '''
+  if value[0].isalpha():
+    return datetime.strptime(value.split(' (', 1)[0][4:], '%b %d %Y %H:%M:%S GMT%z')
+  return datetime.strptime(value + '00', '%Y-%m-%d %H:%M:%S.%f%z')
+
+def test_text_dates_match_strptime():
+  values = generate_timestamps(20000, text_format_fraction=1, days=3 * 365)
+  expected = pd.Series(pd.to_datetime([parse_with_strptime(v) for v in values], utc=True))
+  pd.testing.assert_series_equal(parse_text_dates(values), expected)
+
+def test_text_dates_with_offsets_and_odd_layouts_match_strptime():
+  values = pd.Series([
+    'Mon Feb 29 2016 23:59:59 GMT+0000 (Coordinated Universal Time)',
+    'Wed Dec 31 2020 20:15:00 GMT-0430 (Venezuela Time)',
+    'Fri Jan 01 2021 01:00:00 GMT+0530 (India Standard Time)',
+    'Sat Jan 2 2021 03:04:05 GMT+0000 (Coordinated Universal Time)',
+    'Sun Jan 03 2021 00:00:00 GMT+0000',
+  ])
+  expected = pd.Series(pd.to_datetime([parse_with_strptime(v) for v in values], utc=True))
+  pd.testing.assert_series_equal(parse_text_dates(values), expected)
+
+@pytest.mark.parametrize('value', [
+  'Mon Feb 29 2021 00:00:00 GMT+0000 (Coordinated Universal Time)',
+  'Mon Feb 30 2020 00:00:00 GMT+0000 (Coordinated Universal Time)',
+  'Mon Jan 32 2021 00:00:00 GMT+0000 (Coordinated Universal Time)',
+  'Mon Jan 00 2021 00:00:00 GMT+0000 (Coordinated Universal Time)',
+  'Mon Jan 01 2021 24:00:00 GMT+0000 (Coordinated Universal Time)',
+  'Mon Jan 01 2021 00:60:00 GMT+0000 (Coordinated Universal Time)',
+  'Mon Jan 01 2021 00:00:60 GMT+0000 (Coordinated Universal Time)',
+  'Mon Foo 01 2021 00:00:00 GMT+0000 (Coordinated Universal Time)',
+  'Not a date',
+])
+def test_invalid_text_dates_raise(value):
+  with pytest.raises(ValueError):
+    parse_text_dates(pd.Series(['Sun Sep 27 2020 02:34:57 GMT+0000 (Coordinated Universal Time)', value]))
+
+def test_mixed_formats_match_strptime():
+  values = generate_timestamps(20000, text_format_fraction=0.5, seed=1)
+  df = pd.DataFrame({'time': values})
+  convert_to_datetime(df, 'time')
+  expected = pd.Series(pd.to_datetime([parse_with_strptime(v) for v in values], utc=True), name='time')
+  pd.testing.assert_series_equal(df['time'], expected)
+
+def test_missing_dates_become_nat():
+  df = pd.DataFrame({'time': [None, '2020-09-26 23:30:04.947+00', 'Sun Sep 27 2020 02:34:57 GMT+0000 (Coordinated Universal Time)']})
+  convert_to_datetime(df, 'time')
+  assert pd.isna(df['time'][0])
+  assert df['time'][1] == datetime(2020, 9, 26, 23, 30, 4, 947000, tzinfo=timezone.utc)
+  assert df['time'][2] == datetime(2020, 9, 27, 2, 34, 57, tzinfo=timezone.utc)
+
+def test_invalid_iso_dates_raise():
+  with pytest.raises(ValueError):
+    convert_to_datetime(pd.DataFrame({'time': ['2020-09-26 23:30:04.947+00', '2021-02-29 00:00:00.000+00']}), 'time')
@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+from conftest import write_tables
+from db_manager import (EmbeddedEngine, add_month_start_dates, get_dashboard_aggregates, get_monthly_users_from_parquet,
+                        to_compact_dtypes)
+
+@pytest.fixture(scope='module')
+def table_directory(normalized_exports, tmp_path_factory) -> str:
+  directory = str(tmp_path_factory.mktemp('tables'))
+  write_tables(normalized_exports, directory, 'synthetic')
+  return directory
+
+def get_new_and_returning_users(action_events: pd.DataFrame) -> [pd.DataFrame, pd.DataFrame]:
+  '''
+    Counts the users first active in each month and those active in an earlier month, from the events in memory
+  '''
+  times = action_events['time'].dt.tz_convert('UTC')
+  user_months = pd.DataFrame({'user_id': action_events['user_id'], 'year': times.dt.year, 'month': times.dt.month}).drop_duplicates()
+  month_numbers = user_months['year'] * 12 + user_months['month']
+  is_first_month = month_numbers == month_numbers.groupby(user_months['user_id']).transform('min')
+  counts = []
+  for is_counted in [is_first_month, ~is_first_month]:
+    df = user_months[is_counted].groupby(['year', 'month'], as_index=False, sort=True).size().rename(columns={'size': 'count'})
+    counts.append(add_month_start_dates(to_compact_dtypes(df))[['year', 'month', 'date', 'count']])
+  return counts
+
+def test_aggregates_match_pandas(normalized_exports, table_directory):
+  [total_users, total_new_users, total_returning_users, total_users_by_country, _] = get_dashboard_aggregates(EmbeddedEngine(table_directory))
+  [expected_users, expected_users_by_country] = get_monthly_users_from_parquet(table_directory)
+  [expected_new_users, expected_returning_users] = get_new_and_returning_users(normalized_exports['action_events'])
+
+  pd.testing.assert_frame_equal(total_users, expected_users[total_users.columns])
+  pd.testing.assert_frame_equal(total_users_by_country,
+                                add_month_start_dates(expected_users_by_country)[total_users_by_country.columns])
+  pd.testing.assert_frame_equal(total_new_users, expected_new_users)
+  pd.testing.assert_frame_equal(total_returning_users, expected_returning_users)
+
+def test_changed_files_are_read_again(normalized_exports, tmp_path):
+  events = normalized_exports['action_events']
+  write_tables({'action_events': events[:10000]}, tmp_path, 'first')
+  engine = EmbeddedEngine(str(tmp_path))
+  data_version = engine.get_data_version()
+  first_total = get_dashboard_aggregates(engine)[0]['count'].sum()
+
+  write_tables({'action_events': events[10000:]}, tmp_path, 'second')
+  assert engine.get_data_version() != data_version
+  assert get_dashboard_aggregates(engine)[0]['count'].sum() > first_total
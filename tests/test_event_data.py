@@ -0,0 +1,43 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import event_data
+from event_data import decode_data_column, decode_data_column_in_parallel
+from synthetic import generate_analytics
+
+def normalize_each_row(data: pd.Series) -> pd.DataFrame:
+  '''
+    Normalizes every row into its own DataFrame and concatenates them, as load_events used to
+  '''
+  return (pd.concat({i: pd.json_normalize(json.loads(datum)) for i, datum in data.items()})
+            .reset_index(level=1, drop=True))
+
+def test_known_keys_match_json_normalize():
+  data = generate_analytics(2000)['data']
+  pd.testing.assert_frame_equal(decode_data_column(data), normalize_each_row(data))
+
+def test_other_keys_and_nested_objects_match_json_normalize():
+  data = pd.Series([
+    '{"screen": "Home", "version": 1}',
+    '{"action": "click", "version": 2, "target": "button"}',
+    '{"action": "save", "details": {"size": 3, "kind": "file"}}',
+    '{"version": 1}',
+    '{"screen": "Help", "action": "open"}',
+    '{}',
+  ], index=[10, 11, 12, 13, 14, 15])
+  pd.testing.assert_frame_equal(decode_data_column(data), normalize_each_row(data), check_dtype=False)
+
+def test_missing_data_decodes_to_empty_rows():
+  decoded = decode_data_column(pd.Series(['{"action": "click"}', None]))
+  assert decoded['action'].tolist()[0] == 'click'
+  assert decoded['action'].isna().tolist() == [False, True]
+
+def test_parallel_decoding_matches_single_process(monkeypatch):
+  monkeypatch.setattr(event_data, 'MIN_PARALLEL_ROWS', 100)
+  data = generate_analytics(5000, seed=2)['data']
+  with ProcessPoolExecutor(max_workers=2) as executor:
+    # The same pool serves every call, like the chunks of an export
+    for chunk in [data[:2500], data[2500:]]:
+      pd.testing.assert_frame_equal(decode_data_column_in_parallel(chunk, executor, 2), decode_data_column(chunk))
@@ -0,0 +1,21 @@
+import pandas as pd
+
+from conftest import write_tables
+from db_manager import EmbeddedEngine, get_dashboard_aggregates
+from live_aggregates import merge_aggregates
+
+def test_merged_aggregates_match_a_full_fetch(normalized_exports, tmp_path):
+  # Like a later export adding events from the middle of a month on, to a month that already has some
+  start_time = pd.Timestamp('2020-07-15', tz='UTC')
+  events = {name: normalized_exports[name] for name in ['action_events', 'page_events']}
+  write_tables({name: df[df['time'] < start_time] for name, df in events.items()}, tmp_path, 'earlier')
+  write_tables({name: normalized_exports[name] for name in ['users', 'devices']}, tmp_path, 'users')
+  engine = EmbeddedEngine(str(tmp_path))
+  aggregates = get_dashboard_aggregates(engine)
+
+  write_tables({name: df[df['time'] >= start_time] for name, df in events.items()}, tmp_path, 'later')
+  recent_aggregates = get_dashboard_aggregates(engine, start_time.date())
+  merged = merge_aggregates(aggregates, recent_aggregates, start_time.date())
+
+  for merged_df, full_df in zip(merged, get_dashboard_aggregates(engine)):
+    pd.testing.assert_frame_equal(merged_df, full_df)